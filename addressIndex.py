@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+import sys
+import mmap
+import json
+import zlib
+import struct
+import collections
+
+# Address map index written by yaml2py.py next to each generated python file
+# (-A|--addressIndex option). It maps the name of each register of the top
+# level modules ("Module.Register", "Module.Device.Register" or
+# "Module.Device[2].Register" for the registers of devices) to its address
+# and bit range, so they can be found without importing the python class nor
+# building the PyRogue device tree.
+#
+# The file is memory-mapped and each lookup hashes the name and reads a few
+# fixed size entries, so it takes constant time and only touches the pages
+# it needs. Format (little endian):
+#   header : magic, version, number of registers, number of hash table slots
+#   table  : one 32-bit entry per slot: index of the register + 1, or 0 if empty.
+#            Slot of a name: CRC32 of the name, modulo the number of slots
+#            (a power of two), then the next ones (linear probing).
+#   records: one fixed size record per register:
+#              name (offset and length on the strings)
+#              offset, bitOffset, bitSize, number and stride (0 if not an array)
+#              mode
+#              enum (offset and length on the strings, 0 length if not an enum)
+#   strings: the names, and the enums as JSON lists of [value, name] pairs
+
+magic   = "Y2PYIDX\0"
+version = 1
+
+headerStruct = struct.Struct("<8sIII")
+slotStruct   = struct.Struct("<I")
+recordStruct = struct.Struct("<IIQIIII4sII")
+
+# Register found on the index. Offsets are in bytes, from the base address of
+# the top level module. Arrays have the number of elements and their stride,
+# and number and stride are None otherwise. enum is a {value: name}
+# dictionary, or None if the register is not an enum.
+Register = collections.namedtuple("Register", "name offset bitOffset bitSize number stride mode enum")
+
+# Get the hash table slot of a name
+def nameHash(name):
+    return zlib.crc32(name) & 0xFFFFFFFF
+
+# Get the content of an index file. The entries are (name, offset, bitOffset,
+# bitSize, number, stride, mode, enum) tuples, with the enum as a sequence of
+# (value, name) pairs. If a name is repeated, only the first entry is used.
+def buildIndex(entries):
+    records = []
+    strings = []
+    size    = [0]
+    texts   = {}
+    names   = set()
+
+    # Add a string to the strings, only once. Return its offset and length
+    def addString(text):
+        if text not in texts:
+            texts[text] = (size[0], len(text))
+            strings.append(text)
+            size[0] += len(text)
+        return texts[text]
+
+    for name, offset, bitOffset, bitSize, number, stride, mode, enum in entries:
+        if not isinstance(name, bytes):
+            name = name.encode("utf-8")
+        if not isinstance(mode, bytes):
+            mode = mode.encode("utf-8")
+        if name in names:
+            continue
+        names.add(name)
+
+        nameOffset, nameLength = addString(name)
+        if enum is None:
+            enumOffset, enumLength = 0, 0
+        else:
+            enumOffset, enumLength = addString(json.dumps([list(e) for e in enum]).encode("utf-8"))
+        records.append((name, recordStruct.pack(nameOffset, nameLength, offset, bitOffset, bitSize,
+                                                number or 0, stride or 0, mode, enumOffset, enumLength)))
+
+    # Keep the table at most half full, so the probe sequences are short
+    slots = 1
+    while slots < 2 * len(records):
+        slots *= 2
+
+    table = [0] * slots
+    for i, (name, record) in enumerate(records):
+        slot = nameHash(name) & (slots - 1)
+        while table[slot]:
+            slot = (slot + 1) & (slots - 1)
+        table[slot] = i + 1
+
+    return "".join([headerStruct.pack(magic, version, len(records), slots),
+                     struct.pack("<%dI" % slots, *table)] +
+                    [record for name, record in records] +
+                    strings)
+
+# Index file, memory-mapped
+class AddressIndex:
+    def __init__(self, fileName):
+        with open(fileName, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        fileMagic, fileVersion, self.count, self.slots = headerStruct.unpack_from(self.map, 0)
+        if fileMagic != magic or fileVersion != version:
+            self.map.close()
+            raise ValueError("File \"%s\" is not an address index (version %d)" % (fileName, version))
+
+        self.tableOffset   = headerStruct.size
+        self.recordsOffset = self.tableOffset + self.slots * slotStruct.size
+        self.stringsOffset = self.recordsOffset + self.count * recordStruct.size
+
+    # Method to get the register with a name. Raise KeyError if it is not on the index
+    def lookup(self, name):
+        key  = name.encode("utf-8") if not isinstance(name, bytes) else name
+        mask = self.slots - 1
+        slot = nameHash(key) & mask
+        while True:
+            i = slotStruct.unpack_from(self.map, self.tableOffset + slot * slotStruct.size)[0]
+            if not i:
+                raise KeyError(name)
+
+            record = recordStruct.unpack_from(self.map, self.recordsOffset + (i - 1) * recordStruct.size)
+            if self.getString(record[0], record[1]) == key:
+                return self.getRegister(record)
+
+            slot = (slot + 1) & mask
+
+    # Method to get a string from the strings
+    def getString(self, offset, length):
+        offset += self.stringsOffset
+        return self.map[offset:offset + length]
+
+    # Method to get the register of a record
+    def getRegister(self, record):
+        nameOffset, nameLength, offset, bitOffset, bitSize, number, stride, mode, enumOffset, enumLength = record
+
+        enum = None
+        if enumLength:
+            enum = collections.OrderedDict((value, name) for value, name in json.loads(self.getString(enumOffset, enumLength).decode("utf-8")))
+
+        return Register(self.getString(nameOffset, nameLength).decode("utf-8"), offset, bitOffset, bitSize,
+                        number or None, stride if number else None, mode.rstrip("\0").decode("utf-8"), enum)
+
+    # Method to get the register with a name, or a default value if it is not on the index
+    def get(self, name, default=None):
+        try:
+            return self.lookup(name)
+        except KeyError:
+            return default
+
+    # Method to get all the registers, in the order they were added
+    def registers(self):
+        for i in range(self.count):
+            yield self.getRegister(recordStruct.unpack_from(self.map, self.recordsOffset + i * recordStruct.size))
+
+    def __getitem__(self, name):
+        return self.lookup(name)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Print usage message
+def usage(name):
+    print "Usage: python %s index_file [register_name ...]" % name
+    print "    Print the address and bit range of the registers, or of all the"
+    print "    registers on the index if none is given."
+    print ""
+
+# Print a register
+def printRegister(r):
+    line = "%-48s offset 0x%08X, bits %2d..%2d, %s" % (r.name, r.offset, r.bitOffset, r.bitOffset + r.bitSize - 1, r.mode)
+    if r.number:
+        line += ", %d elements with stride %d" % (r.number, r.stride)
+    if r.enum:
+        line += ", enum %s" % ", ".join("%s:%s" % (value, name) for value, name in r.enum.items())
+    print line
+
+# Main
+def main(argv):
+    if not argv or argv[0] in ("-h", "--help"):
+        usage(sys.argv[0])
+        sys.exit(0 if argv else 2)
+
+    failed = 0
+    with AddressIndex(argv[0]) as index:
+        if len(argv) == 1:
+            for r in index.registers():
+                printRegister(r)
+        for name in argv[1:]:
+            r = index.get(name)
+            if r is None:
+                print "Register \"%s\" not found" % name
+                failed += 1
+            else:
+                printRegister(r)
+
+    if failed:
+        sys.exit(1)
+
+# Call main
+if __name__ == "__main__":
+    main(sys.argv[1:])
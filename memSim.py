@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+import time
+import collections
+
+# The rogue memory interface is only available where rogue is installed.
+# Without it, the simulated memory can be used on its own, but it can't be
+# attached to the generated devices
+try:
+    import rogue
+    import rogue.interfaces.memory as rim
+except ImportError:
+    rogue = None
+    rim   = None
+
+# Get the version of rogue, or None if it is not installed. Rogue 3 and
+# later have rogue.Version, older releases only the package version
+def rogueVersion():
+    if rogue is None:
+        return None
+    if hasattr(rogue, "Version"):
+        return rogue.Version.current()
+    return getattr(rogue, "__version__", "unknown")
+
+# Size of the pages of the simulated memory. Pages are allocated on the
+# first write, so the address space can be as big as the register map
+pageSize = 4096
+
+# Simulated memory: a sparse address space, initially filled with a value,
+# which counts the transactions done on it and the bytes moved
+class SimMemory:
+    def __init__(self, fill=0):
+        self.fill  = fill
+        self.pages = {}
+        self.resetCounts()
+
+    # Method to reset the transaction counters
+    def resetCounts(self):
+        self.reads        = 0
+        self.writes       = 0
+        self.bytesRead    = 0
+        self.bytesWritten = 0
+        self.busyTime     = 0.0
+
+    # Method to get the transaction counters
+    def getCounts(self):
+        return collections.OrderedDict([
+            ("transactions", self.reads + self.writes),
+            ("reads",        self.reads),
+            ("writes",       self.writes),
+            ("bytesRead",    self.bytesRead),
+            ("bytesWritten", self.bytesWritten),
+            ("busyTime",     round(self.busyTime, 6)),
+        ])
+
+    # Method to read a block of memory. Return a bytearray
+    def read(self, address, size):
+        start = time.time()
+        data  = bytearray(size)
+        done  = 0
+        while done < size:
+            page, offset = divmod(address + done, pageSize)
+            length = min(size - done, pageSize - offset)
+            content = self.pages.get(page)
+            if content is None:
+                data[done:done + length] = bytearray([self.fill]) * length
+            else:
+                data[done:done + length] = content[offset:offset + length]
+            done += length
+
+        self.reads     += 1
+        self.bytesRead += size
+        self.busyTime  += time.time() - start
+        return data
+
+    # Method to write a block of memory
+    def write(self, address, data):
+        start = time.time()
+        done  = 0
+        while done < len(data):
+            page, offset = divmod(address + done, pageSize)
+            length = min(len(data) - done, pageSize - offset)
+            content = self.pages.get(page)
+            if content is None:
+                content = self.pages[page] = bytearray([self.fill]) * pageSize
+            content[offset:offset + length] = data[done:done + length]
+            done += length
+
+        self.writes       += 1
+        self.bytesWritten += len(data)
+        self.busyTime     += time.time() - start
+
+# Memory slave serving the transactions of the devices from a simulated
+# memory. Pass it as the memBase of a generated device to run it without
+# hardware. Defined only if rogue is installed.
+if rim is not None:
+    class MemSim(rim.Slave):
+        def __init__(self, memory=None, minAccess=4, maxAccess=4096):
+            rim.Slave.__init__(self, minAccess, maxAccess)
+            self.memory = memory if memory is not None else SimMemory()
+
+        # Serve a transaction. Writes and posted writes store the data,
+        # reads and verifies get it. Rogue 3 and later pass a transaction
+        # object; rogue 2 passes the transaction id, the master, the address,
+        # the size and the type, and the data is moved through the master
+        def _doTransaction(self, *args):
+            if len(args) == 1:
+                transaction = args[0]
+                address = transaction.address()
+                size    = transaction.size()
+                write   = transaction.type() in (rim.Write, rim.Post)
+                getData = transaction.getData
+                setData = transaction.setData
+            else:
+                tid, master, address, size, ttype = args
+                write   = ttype in (rim.Write, rim.Post)
+                getData = lambda data, offset: master._getTransactionData(tid, data, offset)
+                setData = lambda data, offset: master._setTransactionData(tid, data, offset)
+
+            if write:
+                data = bytearray(size)
+                getData(data, 0)
+                self.memory.write(address, data)
+            else:
+                setData(self.memory.read(address, size), 0)
+
+            if len(args) == 1:
+                transaction.done()
+            else:
+                self._doneTransaction(tid, 0)
+else:
+    MemSim = None
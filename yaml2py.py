@@ -5,12 +5,81 @@ import os
 import getopt
 import datetime
 import collections
+import heapq
+import cPickle
+import glob
+import multiprocessing
+import hashlib
+import json
+import tempfile
+import re
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import filecmp
+import addressIndex
+
+# The resource module is only available on Unix. Without it, the peak
+# memory is not reported on the statistics
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__version__ = "1.1.0"
+
+# Name of the manifest file used on incremental mode
+manifestName = ".yaml2py.manifest"
+
+# Process file creation mask, used to set the permission of the files
+# written atomically
+umask = os.umask(0)
+os.umask(umask)
 
 # Print usage message
 def usage(name):
-    print "Usage: python %s [-h|--help] -M|--module module_name [-T|--title module_title]  [-Y|--yamlDir yaml_dir] [P|--pythonDir python_dir] [-D|--description module_description]" % name
+    print "Usage: python %s [-h|--help] -M|--module module_name [-T|--title module_title]  [-Y|--yamlDir yaml_dir] [P|--pythonDir python_dir] [-D|--description module_description] [-C|--cacheDir cache_dir] [-c|--compact] [-S|--split group_size] [-z|--lazy] [-O|--coalesce] [-W|--batchWrites] [-w|--watch] [-s|--stats stats_file] [-E|--sharedEnums] [-d|--dedup] [-A|--addressIndex] [-L|--bulkArrays min_elements] [-N|--noCheck] [-X|--stream]" % name
+    print "       python %s [-h|--help] -B|--batch yaml_dir|yaml_glob [-j|--jobs jobs] [-I|--incremental] [-C|--cacheDir cache_dir] [-c|--compact] [-S|--split group_size] [-z|--lazy] [-O|--coalesce] [-W|--batchWrites] [-w|--watch] [-s|--stats stats_file] [-E|--sharedEnums] [-d|--dedup] [-A|--addressIndex] [-L|--bulkArrays min_elements] [-N|--noCheck] [-X|--stream] [P|--pythonDir python_dir]" % name
     print "    -h|--help                           : show this message"
     print "    -M|--module module_name             : module name"
+    print "    -B|--batch yaml_dir|yaml_glob       : convert all the YAML files found on a directory tree or matching a glob pattern"
+    print "    -j|--jobs jobs                      : number of parallel conversion jobs used in batch mode."
+    print "                                          If empty, the number of CPUs will be used."
+    print "    -I|--incremental                    : only regenerate the modules whose YAML file or options changed since"
+    print "                                          the last run, according to the manifest kept on the python directory."
+    print "    -C|--cacheDir cache_dir             : keep the parsed YAML documents on this directory, so files whose content"
+    print "                                          didn't change are not parsed again."
+    print "    -c|--compact                        : define the variables on a table, added by a loop, instead of calling"
+    print "                                          addVariable once for each one. Smaller files, faster to byte-compile, but slower to import."
+    print "    -S|--split group_size               : write each module as a package, with its variables (in groups of"
+    print "                                          group_size) and devices on their own files, built by the constructor."
+    print "    -z|--lazy                           : on split mode, build each group of children only when one of them is"
+    print "                                          first accessed. The children not accessed yet are not on the PyRogue"
+    print "                                          tree: call loadAll() before the root is started."
+    print "    -O|--coalesce                       : order the variables by address and add a bulk read plan, reading the"
+    print "                                          whole device with the fewest transactions."
+    print "    -W|--batchWrites                    : stage the writes of the command sequences and commit them in batches,"
+    print "                                          instead of writing each entry on its own transaction."
+    print "    -w|--watch                          : after converting the modules, keep watching their YAML files and"
+    print "                                          convert again the modules affected by each change."
+    print "    -s|--stats stats_file               : write the wall time and peak memory of each conversion phase, and the"
+    print "                                          number of variables, commands, enums and arrays, of each file as JSON."
+    print "    -E|--sharedEnums                    : write each different enum table once, on the %s module of the" % enumsModule
+    print "                                          python directory, shared by all the variables and modules using it."
+    print "    -d|--dedup                          : write the classes of the modules with the same structure only once, on"
+    print "                                          a shared file, and derive the class of each module from it."
+    print "    -A|--addressIndex                   : also write an index with the address and bit range of each register,"
+    print "                                          which can be memory-mapped by addressIndex.py to find them by name."
+    print "    -L|--bulkArrays min_elements        : read and write the arrays of at least min_elements elements as a block,"
+    print "                                          into a numpy array, instead of defining a variable for each element."
+    print "    -N|--noCheck                        : don't check the address map of the modules for overlapping and misaligned"
+    print "                                          variables."
+    print "    -X|--stream                         : read the YAML file as a stream, writing each child as soon as it is read,"
+    print "                                          so the memory used doesn't depend on the file size. The address map is"
+    print "                                          not checked. Includes, aliases, split, coalesce, batch writes, dedup and"
+    print "                                          address index modes are not supported."
     print "    -Y|--yamlDir yaml_dir               : Yaml input file directory"
     print "    -P|--pythonDir python_dir           : Python output file directory"
     print "    -T|--title module_title             : module title to write on the file header."
@@ -20,109 +89,685 @@ def usage(name):
     print ""
 
 # Add File header
-def printHeader(file, title, module, date, description):
-    file.write("#!/usr/bin/env python\n")
-    file.write("#-----------------------------------------------------------------------------\n")
-    file.write("# Title      : %s\n" % title)
-    file.write("#-----------------------------------------------------------------------------\n")
-    file.write("# File       : %s.py\n" % module)
-    file.write("# Created    : %s\n" % date)
-    file.write("#-----------------------------------------------------------------------------\n")
-    file.write("# Description:\n")
-    file.write("# %s\n" % description)
-    file.write("#-----------------------------------------------------------------------------\n")
-    file.write("# This file is part of the rogue software platform. It is subject to\n")
-    file.write("# the license terms in the LICENSE.txt file found in the top-level directory\n")
-    file.write("# of this distribution and at:\n")
-    file.write("#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.\n")
-    file.write("# No part of the rogue software platform, including this file, may be\n")
-    file.write("# copied, modified, propagated, or distributed except according to the terms\n")
-    file.write("# contained in the LICENSE.txt file.\n")
-    file.write("#-----------------------------------------------------------------------------\n")
-    file.write("\n")
-    file.write("import pyrogue as pr\n")
-    file.write("\n")
-
+def printHeader(buf, title, module, date, description, options=None, package=False, sleeps=False):
+    buf.append("#!/usr/bin/env python\n")
+    buf.append("#-----------------------------------------------------------------------------\n")
+    buf.append("# Title      : %s\n" % title)
+    buf.append("#-----------------------------------------------------------------------------\n")
+    buf.append("# File       : %s.py\n" % module)
+    buf.append("# Created    : %s\n" % date)
+    buf.append("#-----------------------------------------------------------------------------\n")
+    buf.append("# Description:\n")
+    buf.append("# %s\n" % description)
+    buf.append(getLicenseHeader(options, package, sleeps))
+
+# Add the header of a file shared by the generated modules. It has no creation
+# date, so its content only depends on what it defines
+def printSharedHeader(buf, title, module, description, fixedHeader):
+    buf.append("#!/usr/bin/env python\n")
+    buf.append("#-----------------------------------------------------------------------------\n")
+    buf.append("# Title      : %s\n" % title)
+    buf.append("#-----------------------------------------------------------------------------\n")
+    buf.append("# File       : %s.py\n" % module)
+    buf.append("#-----------------------------------------------------------------------------\n")
+    buf.append("# Description:\n")
+    buf.append("# %s\n" % description)
+    buf.append(fixedHeader)
+
+# Fixed part of the file header
+licenseHeader = (
+    "#-----------------------------------------------------------------------------\n"
+    "# This file is part of the rogue software platform. It is subject to\n"
+    "# the license terms in the LICENSE.txt file found in the top-level directory\n"
+    "# of this distribution and at:\n"
+    "#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.\n"
+    "# No part of the rogue software platform, including this file, may be\n"
+    "# copied, modified, propagated, or distributed except according to the terms\n"
+    "# contained in the LICENSE.txt file.\n"
+    "#-----------------------------------------------------------------------------\n"
+    "\n"
+    "import pyrogue as pr\n"
+    "\n")
+
+# Name of the module with the enum tables shared by the generated modules,
+# used on shared enums mode
+enumsModule = "yaml2pyEnums"
+
+# Get the import of a module of the python directory from a generated file.
+# It is imported relative to the file, so the python directory can be a
+# package; if it is not, it must be on the python path, as the generated
+# modules are imported from it, and the absolute import is used
+def relativeImport(relative, absolute):
+    return "try:\n    %s\nexcept (ImportError, ValueError):\n    %s\n" % (relative, absolute)
+
+# Get the fixed part of the file header. On bulk arrays mode numpy is
+# imported too, and on shared enums mode, the module with the shared enum
+# tables. If the file is part of a package written on split mode, the shared
+# enums module is imported from the parent directory. If the command
+# sequences of the file sleep between their batches of writes, on batch
+# writes mode, time is imported
+def getLicenseHeader(options, package=False, sleeps=False):
+    imports = []
+    if sleeps:
+        imports.append("import time\n")
+    if options and options.get("bulkArrays"):
+        imports.append("import numpy\n")
+    if options and options.get("sharedEnums"):
+        imports.append(relativeImport("from %s import %s" % (".." if package else ".", enumsModule), "import %s" % enumsModule))
+    if imports:
+        return "%s%s\n" % (licenseHeader[:-1], "".join(imports))
+    return licenseHeader
+
+# Column layout of the generated code. The indentation of each level and
+# the labels padded to fill the columns between two levels are built once
+# and reused for every line rendered with this layout.
+class Layout:
+    def __init__(self, levels):
+        self.levels = levels
+        self.labels = {}
+
+        # Indentation up to each level
+        self.indent = {}
+        for l in levels:
+            self.indent[l] = ' '.ljust(levels[l])
+
+    # Get a text padded to fill the columns from level 'start' to level 'end'
+    def label(self, text, start, end):
+        key = (text, start, end)
+        try:
+            return self.labels[key]
+        except KeyError:
+            label = self.labels[key] = text.ljust(self.levels[end] - self.levels[start])
+            return label
+
+    # Get a text padded to fill the columns from level 'start' to level 'end',
+    # preceded by the indentation up to level 'start'
+    def field(self, text, start, end):
+        key = (text, start, end, True)
+        try:
+            return self.labels[key]
+        except KeyError:
+            label = self.labels[key] = self.indent[start] + self.label(text, start, end)
+            return label
 
 # Setup support for ordered dicts so we do not lose ordering
 # when importing from YAML
-def dict_representer(dumper, data):
-    return dumper.represent_mapping(_mapping_tag, data.iteritems())
-
 def dict_constructor(loader, node):
+    # Resolve the merge keys ("<<: *anchor") used by CPSW to instantiate
+    # devices. The merged nodes are shared, so all the devices merged from
+    # the same anchor get the very same "children" object.
+    loader.flatten_mapping(node)
     return collections.OrderedDict(loader.construct_pairs(node))
 
+# YAML loader. Use the libyaml based loader when PyYAML was built with it,
+# as it is much faster than the pure python one. The ordered dict constructor
+# is registered only on this loader, so PyYAML's global state is not modified.
+if getattr(yaml, "__with_libyaml__", False):
+    class OrderedLoader(yaml.CSafeLoader):
+        pass
+else:
+    class OrderedLoader(yaml.SafeLoader):
+        pass
+
+OrderedLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, dict_constructor)
+
+# Version of the parsed document cache format. Change it when the structure
+# of the loaded documents change, to invalidate the old cache entries.
+cacheVersion = 2
+
+# CPSW preprocessor include directive: "#include file.yaml"
+includeRe = re.compile(r'^#include\s+["<]?([^">\s]+)[">]?', re.M)
+
+# Stamp, content and include list of each YAML file already read, by file
+# path. Each file is read and scanned only once, no matter how many files
+# include it. The files only scanned for their includes (to hash or watch
+# them) have no content, so a large file is not kept in memory.
+sourceCache = {}
+
+# Size of the chunks the YAML files are hashed in
+hashChunkSize = 1 << 20
+
+# Get the paths of the files included by a YAML file, from the include names.
+# Included files are searched on the directory of the file including them
+def includePaths(yamlFile, names):
+    includes = []
+    for inc in names:
+        incFile = os.path.join(os.path.dirname(yamlFile), inc)
+        if not os.path.isfile(incFile):
+            raise IOError("File \"%s\" included from \"%s\" doesn't exist" % (inc, yamlFile))
+        includes.append(os.path.abspath(incFile))
+    return includes
+
+# Read a YAML file and get the list of files it includes
+def readYamlFile(yamlFile):
+    yamlFile = os.path.abspath(yamlFile)
+    st = os.stat(yamlFile)
+
+    entry = sourceCache.get(yamlFile)
+    if entry and entry[0] == (st.st_mtime, st.st_size) and entry[1] is not None:
+        return entry[1], entry[2]
+
+    with open(yamlFile, "rb") as f:
+        data = f.read()
+
+    includes = includePaths(yamlFile, includeRe.findall(data))
+    sourceCache[yamlFile] = ((st.st_mtime, st.st_size), data, includes)
+
+    return data, includes
+
+# Get the list of files a YAML file includes, scanning it line by line
+# without keeping its content
+def yamlIncludes(yamlFile):
+    yamlFile = os.path.abspath(yamlFile)
+    st = os.stat(yamlFile)
+
+    entry = sourceCache.get(yamlFile)
+    if entry and entry[0] == (st.st_mtime, st.st_size):
+        return entry[2]
+
+    with open(yamlFile, "rb") as f:
+        includes = includePaths(yamlFile, [inc.group(1) for inc in map(includeRe.match, f) if inc])
+    sourceCache[yamlFile] = ((st.st_mtime, st.st_size), None, includes)
+
+    return includes
+
+# Get the list of files needed to load a YAML file: the file itself and all
+# the files it includes, directly or not. Each file appears only once, after
+# all the files it includes, like CPSW's "#once" guards do.
+def yamlDependencies(yamlFile, deps=None, visited=None):
+    if deps is None:
+        deps    = []
+        visited = set()
+
+    yamlFile = os.path.abspath(yamlFile)
+    if yamlFile in visited:
+        return deps
+    visited.add(yamlFile)
+
+    for inc in yamlIncludes(yamlFile):
+        yamlDependencies(inc, deps, visited)
+
+    deps.append(yamlFile)
+
+    return deps
+
+# Get the SHA1 hash of the YAML source of a file: the content of all the
+# files it includes, followed by its own content. The files are hashed in
+# chunks, so their content is neither cached nor joined. The hash can be
+# started with a prefix.
+def sourceHash(yamlFile, prefix=""):
+    h = hashlib.sha1(prefix)
+    for i, dep in enumerate(yamlDependencies(yamlFile)):
+        if i:
+            h.update("\n")
+        with open(dep, "rb") as f:
+            for chunk in iter(lambda: f.read(hashChunkSize), ""):
+                h.update(chunk)
+    return h.hexdigest()
+
+# Get the modules defined on a YAML text itself, from its loaded document:
+# its top level keys, leaving out the ones defined on the files it includes
+# ('deps'). Fail if there are none, as nothing would be converted
+def ownModules(doc, deps, source):
+    included = set()
+    for dep in deps:
+        included.update(includedModules(dep))
+
+    own = [module for module in (doc or {}) if module not in included]
+    if not own:
+        raise ValueError("No modules defined on %s" % source)
+    return own
+
+# Anchors defined on each included file already parsed, the objects built
+# from its nodes and its top level keys, by file path, with the modification
+# time and size of the file and of the files it includes. Each included file
+# is parsed and built only once, no matter how many files include it.
+includeCache = {}
+
+# Build the next node from the parser events. The anchors found are added to
+# 'anchors', and the aliases are taken from it. If it is None, aliases are
+# not supported
+def composeNode(loader, anchors=None):
+    event = loader.get_event()
+
+    if isinstance(event, yaml.AliasEvent):
+        if anchors is None:
+            raise yaml.YAMLError("Aliases are not supported on streaming mode\n%s" % event.start_mark)
+        if event.anchor not in anchors:
+            raise yaml.composer.ComposerError(None, None, "found undefined alias %s" % event.anchor, event.start_mark)
+        return anchors[event.anchor]
+
+    if isinstance(event, yaml.ScalarEvent):
+        tag = event.tag
+        if tag is None or tag == "!":
+            tag = loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+        node = yaml.ScalarNode(tag, event.value, event.start_mark, event.end_mark, style=event.style)
+
+    elif isinstance(event, yaml.SequenceStartEvent):
+        tag = event.tag
+        if tag is None or tag == "!":
+            tag = loader.resolve(yaml.SequenceNode, None, event.implicit)
+        node = yaml.SequenceNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+        if anchors is not None and event.anchor is not None:
+            anchors[event.anchor] = node
+        while not loader.check_event(yaml.SequenceEndEvent):
+            node.value.append(composeNode(loader, anchors))
+        node.end_mark = loader.get_event().end_mark
+        return node
+
+    elif isinstance(event, yaml.MappingStartEvent):
+        tag = event.tag
+        if tag is None or tag == "!":
+            tag = loader.resolve(yaml.MappingNode, None, event.implicit)
+        node = yaml.MappingNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+        if anchors is not None and event.anchor is not None:
+            anchors[event.anchor] = node
+        while not loader.check_event(yaml.MappingEndEvent):
+            node.value.append((composeNode(loader, anchors), composeNode(loader, anchors)))
+        node.end_mark = loader.get_event().end_mark
+        return node
+
+    else:
+        raise yaml.YAMLError("Unexpected %s\n%s" % (type(event).__name__, event.start_mark))
+
+    if anchors is not None and event.anchor is not None:
+        anchors[event.anchor] = node
+    return node
+
+# Build the node of the single document of a YAML stream, or None if it is empty
+def composeDocument(loader, anchors):
+    loader.get_event()
+    node = None
+    if not loader.check_event(yaml.StreamEndEvent):
+        loader.get_event()
+        node = composeNode(loader, anchors)
+        loader.get_event()
+    if not loader.check_event(yaml.StreamEndEvent):
+        raise yaml.composer.ComposerError("expected a single document in the stream", None,
+                                          "but found another document", loader.get_event().start_mark)
+    return node
+
+# Get the anchors defined on an included file, by name, and the objects built
+# from its nodes, by node. The file is parsed with the anchors of the files
+# it includes already defined and built, and its nodes and objects are shared
+# by all the files including it
+def includeAnchors(incFile):
+    deps  = yamlDependencies(incFile)
+    stamp = [sourceCache[dep][0] for dep in deps]
+
+    entry = includeCache.get(deps[-1])
+    if entry and entry[0] == stamp:
+        return entry[1], entry[2]
+
+    seeds   = {}
+    objects = {}
+    for dep in deps[:-1]:
+        depAnchors, depObjects = includeAnchors(dep)
+        seeds.update(depAnchors)
+        objects.update(depObjects)
+
+    anchors = dict(seeds)
+    loader  = OrderedLoader(readYamlFile(deps[-1])[0])
+    try:
+        node = composeDocument(loader, anchors)
+        keys = mappingKeys(node)
+
+        own = dict((name, node) for name, node in anchors.items() if seeds.get(name) is not node)
+        loader.constructed_objects.update(objects)
+        for node in own.values():
+            loader.construct_object(node, deep=True)
+        objects = dict(loader.constructed_objects)
+    finally:
+        loader.dispose()
+
+    includeCache[deps[-1]] = (stamp, own, objects, keys)
+
+    return own, objects
+
+# Get the top level keys of an included file, which are the modules defined
+# on it. If it can't be parsed on its own (it uses an anchor of a file it
+# doesn't include), it is only composed, with the undefined aliases left empty
+def includedModules(incFile):
+    try:
+        includeAnchors(incFile)
+    except yaml.composer.ComposerError:
+        loader = OrderedLoader(readYamlFile(incFile)[0])
+        try:
+            return mappingKeys(composeDocument(loader, AnyAnchors()))
+        finally:
+            loader.dispose()
+    return includeCache[os.path.abspath(incFile)][3]
+
+# Anchors of a YAML document which is only composed to get its structure:
+# every alias is defined, as an empty node
+class AnyAnchors(dict):
+    def __contains__(self, name):
+        return True
+
+    def __missing__(self, name):
+        return yaml.ScalarNode("tag:yaml.org,2002:null", "")
+
+# Get the scalar keys of a mapping node, or none if it is not a mapping
+def mappingKeys(node):
+    if not isinstance(node, yaml.MappingNode):
+        return []
+    return [key.value for key, value in node.value if isinstance(key, yaml.ScalarNode)]
+
+# Parse the YAML text of a file, with the anchors of the files it includes
+# ('deps', in include order) already defined and built, so the included files
+# are not parsed again for each file including them, and the devices merged
+# from them share their objects. Files without includes are parsed by libyaml
+# alone. If an included file can't be parsed on its own (it uses an anchor of
+# a file it doesn't include), the whole YAML source is parsed instead, as a
+# single text
+def parseYaml(data, deps):
+    if not deps:
+        return yaml.load(data, Loader=OrderedLoader)
+
+    try:
+        anchors = {}
+        objects = {}
+        for dep in deps:
+            depAnchors, depObjects = includeAnchors(dep)
+            anchors.update(depAnchors)
+            objects.update(depObjects)
+    except yaml.composer.ComposerError:
+        return yaml.load("\n".join([readYamlFile(dep)[0] for dep in deps] + [data]), Loader=OrderedLoader)
+
+    loader = OrderedLoader(data)
+    try:
+        node = composeDocument(loader, anchors)
+        if node is None:
+            return None
+        loader.constructed_objects.update(objects)
+        return loader.construct_document(node)
+    finally:
+        loader.dispose()
+
+# Load a YAML file, resolving its includes. If a cache directory is given,
+# the parsed document is stored there keyed by the content hash, so the next
+# time the same content is loaded the parsing is skipped.
+def loadYaml(yamlFile, cacheDir=None):
+    if not cacheDir:
+        return parseYaml(readYamlFile(yamlFile)[0], yamlDependencies(yamlFile)[:-1])
+
+    key       = sourceHash(yamlFile, "%d\n" % cacheVersion)
+    cacheFile = os.path.join(cacheDir, key + ".pickle")
+
+    # A missing entry is parsed. A truncated or stale one can fail in many
+    # ways (ValueError, AttributeError, ImportError, IndexError...), so it is
+    # parsed too and its entry written again
+    try:
+        with open(cacheFile, "rb") as f:
+            return cPickle.load(f)
+    except Exception:
+        pass
+
+    doc = parseYaml(readYamlFile(yamlFile)[0], yamlDependencies(yamlFile)[:-1])
+
+    if not os.path.isdir(cacheDir):
+        try:
+            os.makedirs(cacheDir)
+        except OSError:
+            # Another worker could have created it at the same time
+            if not os.path.isdir(cacheDir):
+                raise
+
+    writeFileAtomic(cacheFile, cPickle.dumps(doc, cPickle.HIGHEST_PROTOCOL))
+
+    return doc
+
 # Class to process a YAML file
 class YamlDoc:
-    def __init__(self, yamlFile, title, description, date):
-        
-        # Open YAML file
-        yFile = open(yamlFile, "r")
-
-        # Setup support for ordered dicts so we do not lose ordering
-        # when importing from YAML
-        _mapping_tag = yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG
-        yaml.add_representer(collections.OrderedDict, dict_representer)
-        yaml.add_constructor(_mapping_tag, dict_constructor)
-
-        # Read the YAML definitions
-        doc = yaml.load(yFile)
-    
-        # Get all the modules defined on the file
-        # Usually there will be just one. 
-        k = doc.keys()
-        self.yM = []
-        for module in k:
-            self.yM.append(YamlModule(doc, module, title, description, date))
+    def __init__(self, yamlFile, title, description, date, cacheDir=None, options=None, doc=None, deps=None):
+
+        # Read the YAML definitions, unless they were already loaded
+        if doc is None and yamlFile is not None:
+            doc = loadYaml(yamlFile, cacheDir)
 
-        # Close the file
-        yFile.close()
+        # Modules already processed, by identity of their definition. They
+        # are shared by all the devices instantiating them, so each module
+        # is processed only once. They are kept in the order they are processed.
+        devices = collections.OrderedDict()
+
+        # Get all the modules defined on the file, but not the ones
+        # defined on included files. Usually there will be just one.
+        if deps is None:
+            deps = yamlDependencies(yamlFile)[:-1]
+        self.yM = []
+        for module in ownModules(doc, deps, yamlFile or "the YAML text"):
+            ym = devices.get(moduleKey(doc[module]))
+            if ym and ym.name == module and ym not in self.yM:
+                # The module was already processed as a device of a previous module
+                ym.setTop(title, description)
+            else:
+                # Each top level module gets its own class, named as its key,
+                # even if its definition is the same as other module's
+                ym = YamlModule(doc, module, title, description, date, devices, options)
+            self.yM.append(ym)
+
+        # All the processed modules: the ones instantiated as devices and the
+        # top level ones. Only the extracted values are kept, so the YAML
+        # document can be freed: the identities used as keys are not valid
+        # anymore once it is.
+        self.modules = devices.values()
+        self.modules += [ym for ym in self.yM if ym not in self.modules]
 
     # Method to get the equivalent python class
-    def getPyClass(self, file):
+    def getPyClass(self, buf):
         # For every module, call its getPyClass method
+        emitted = set()
         for ym in self.yM:
-            ym.getPyClass(file)
+            ym.getPyClass(buf, emitted)
+
+    # Method to get the equivalent python code, as a list of parts. On dedup
+    # mode, the class of each module which could derive from a shared class
+    # is a (shared class name, own class, derived class) tuple, as the shared
+    # classes are only known once all the modules converted together are built
+    def renderParts(self):
+        buf = []
+        self.getPyClass(buf)
+        return buf
+
+    # Method to get the equivalent python code as a string. On dedup mode, the
+    # modules derive from the classes shared by at least two modules: the
+    # ones given, or else the ones of the modules of this file
+    def render(self, shared=None):
+        if shared is None:
+            shared = self.getShared()
+        return joinParts(self.renderParts(), shared)
+
+    # Method to get the conversion report lines of all the modules, including
+    # the modules instantiated as devices
+    def getReport(self, shared=None):
+        if shared is None:
+            shared = self.getShared()
+        report = []
+        for ym in self.modules:
+            ym.getReport(report, shared)
+        return report
+
+    # Method to get the number of modules, variables, commands, devices, enums
+    # and arrays of the file, including the modules instantiated as devices
+    def getStats(self):
+        return getModuleStats(self.modules)
+
+    # Method to get the shared enum tables used by the modules, by name
+    def getEnums(self):
+        return getModuleEnums(self.modules)
+
+    # Method to get the number of modules of the file with each structure, by
+    # the name of the class they would share, used on dedup mode
+    def getStructures(self):
+        structures = {}
+        for ym in self.modules:
+            if ym.baseName:
+                structures[ym.baseName] = structures.get(ym.baseName, 0) + 1
+        return structures
+
+    # Method to get the names of the classes shared by the modules of the
+    # file, used on dedup mode
+    def getShared(self):
+        return sharedBases(self.getStructures())
+
+    # Method to get the files of the classes shared by the modules with the
+    # same structure, by class name, used on dedup mode: the given ones, or
+    # else the ones shared by the modules of this file
+    def getBases(self, shared=None):
+        if shared is None:
+            shared = self.getShared()
+        bases = {}
+        for ym in self.modules:
+            if ym.baseName in shared and ym.baseName not in bases:
+                bases[ym.baseName] = ym.getPyBaseFile()
+        return bases
+
+    # Method to get the content of the address index of the top level modules
+    def getIndex(self):
+        entries = []
+        for ym in self.yM:
+            ym.getIndexEntries(entries, ym.name + ".", 0)
+        return addressIndex.buildIndex(entries)
+
+    # Method to get the equivalent python package, used on split mode.
+    # Return the content of each file of the package, by file name
+    def renderPackage(self):
+        buf     = []
+        files   = collections.OrderedDict()
+        emitted = set()
+        for ym in self.yM:
+            ym.getPyPackage(buf, files, emitted)
+        files["__init__.py"] = "".join(buf)
+        return files
+
+# Get the names of the classes shared on dedup mode, from the number of
+# modules with each structure: only the ones of at least two modules are shared
+def sharedBases(structures):
+    return set(name for name, count in structures.items() if count > 1)
+
+# Join the parts of the python code of a file. The modules which could derive
+# from a shared class get the derived class if it is shared, or else their own
+def joinParts(parts, shared):
+    buf = []
+    for p in parts:
+        if isinstance(p, tuple):
+            p = p[2] if p[0] in shared else p[1]
+        buf.append(p)
+    return "".join(buf)
+
+# Get the number of modules, variables, commands, devices, enums and arrays
+# of a list of modules
+def getModuleStats(modules):
+    stats = collections.OrderedDict([("modules",0), ("variables",0), ("commands",0), ("devices",0),
+                                     ("enums",0), ("enumValues",0), ("arrays",0), ("arrayElements",0),
+                                     ("bulkArrays",0), ("overlaps",0), ("misaligned",0), ("gaps",0)])
+    for ym in modules:
+        ym.getStats(stats)
+    return stats
+
+# Get the shared enum tables used by a list of modules, by name
+def getModuleEnums(modules):
+    enums = {}
+    for ym in modules:
+        enums.update(ym.enums)
+    return enums
+
+# Shared enum tables already built, by enum values and names
+sharedEnums = {}
+
+# Get the name and the definition of the shared enum table of an enum, used on
+# shared enums mode. The name is built from the hash of the enum content, so
+# the same enum gets the same name on all the modules
+def getSharedEnum(enum):
+    key = tuple([(value, "%s" % name) for value, name in enum])
+    try:
+        return sharedEnums[key]
+    except KeyError:
+        table = "{%s}" % ", ".join("%d:\"%s\"" % item for item in key)
+        name  = "Enum_%s" % hashlib.sha1(table).hexdigest()[:12]
+        sharedEnums[key] = (name, "%s = %s\n" % (name, table))
+        return sharedEnums[key]
+
+# Maximum number of overlapping and misaligned variables reported for each module
+maxCheckReports = 10
+
+# Get the name of the variable of a bit range, with the index on arrays
+def bitRangeName(r):
+    if r[3] is None:
+        return r[2]
+    return "%s[%d]" % (r[2], r[3])
+
+# Get the bit ranges of the elements of an array, in order, as (first bit,
+# last bit + 1, name, index) tuples
+def arrayBitRanges(r):
+    start, end, name, number, stride = r
+    for i in xrange(number):
+        yield (start + i * stride, end + i * stride, name, i)
+
+# Get a bit range as offset and bits of the word
+def bitRangeText(r):
+    return "offset 0x%02X, bits %d-%d" % (r[0] // 32 * 4, r[0] % 32, r[0] % 32 + r[1] - r[0] - 1)
+
+# Options changing the code of the classes, which are part of the structure of
+# the modules on dedup mode
+structureOptions = ("compact", "coalesce", "batchWrites", "sharedEnums", "bulkArrays")
 
 # Class to process a module on the YAML file
 class YamlModule:
-    def __init__(self, doc, module, title, description, date):
-        # Indentation levels
-        #
-        #------------------------------------------------------------------>|<-L6
-        #----------------------------------------------------------->|<-L5  |
-        #------------------------------------------------->|<-L4     |      |
-        #------------------------------------------>|<-L3  |         |      |
-        #------------------------>|<- L1            |      |         |      |
-        #class module(pr.Device): |                 |      |         |      |
-        #                         |def __init__(    |      |self     |      |
-        #                                           |      |name     |=     |"name"
-        #                                           |      |...
-        #                                           |):
-        #
-        #                                 |super(...)
-        #                                 |
-        #                                 |##############################
-        #                                 |# Variables
-        #                                 |##############################
-        #-------------------------------->|<- L2 
-        #
-        self.identL1 = 4
-        self.identL2 = 8
-        self.identL3 = 16
-        self.identL4 = 20
-        self.identL5 = 32
-        self.identL6 = 34
-
+    # Indentation levels
+    #
+    #------------------------------------------------------------------>|<-L6
+    #----------------------------------------------------------->|<-L5  |
+    #------------------------------------------------->|<-L4     |      |
+    #------------------------------------------>|<-L3  |         |      |
+    #------------------------>|<- L1            |      |         |      |
+    #class module(pr.Device): |                 |      |         |      |
+    #                         |def __init__(    |      |self     |      |
+    #                                           |      |name     |=     |"name"
+    #                                           |      |...
+    #                                           |):
+    #
+    #                                 |super(...)
+    #                                 |
+    #                                 |##############################
+    #                                 |# Variables
+    #                                 |##############################
+    #-------------------------------->|<- L2
+    #
+    layout = Layout({1:4, 2:8, 3:16, 4:20, 5:32, 6:34})
+
+    def __init__(self, doc, module, title, description, date, devices=None, options=None):
         # Assume this module it's not defined
         self.isDefined = False
 
         # Assume this module doesn't have children
         self.hasChildren = False
 
-        # Variable and Command children counter
-        self.variableCount = 0
-        self.commandCount  = 0
+        # Variable, Command and Device children counter, and the arrays read
+        # and written as a block on bulk arrays mode (not counted as variables)
+        self.variableCount  = 0
+        self.commandCount   = 0
+        self.deviceCount    = 0
+        self.bulkArrayCount = 0
+
+        # Enum and array variables counter, and their number of values and elements
+        self.enumCount         = 0
+        self.enumValueCount    = 0
+        self.arrayCount        = 0
+        self.arrayElementCount = 0
+
+        # Shared enum tables used by the variables, by name, on shared enums mode
+        self.enums = {}
+
+        # Bit ranges of the variables and of the arrays, used to check the
+        # address map, and the result of the check
+        self.bitRanges    = []
+        self.arrayRanges  = []
+        self.addressCheck = None
+
+        # Modules are top level (with file header) unless they are instantiated
+        # only as devices of other modules
+        self.isTop = True
 
         # Module details
         self.name        = module
@@ -130,34 +775,31 @@ class YamlModule:
         self.description = description
         self.date        = date
 
+        # Code generation options
+        self.options = options or {}
+
+        # On dedup mode, hash of the structure of the module, and the name of
+        # the class shared by all the modules with the same structure
+        self.structure = None
+        self.baseName  = None
+        if self.options.get("dedup"):
+            self.structure = hashlib.sha1(repr([self.options.get(o) for o in structureOptions]))
+
+        # Register this module before processing its children, so it is
+        # reused by all the devices instantiating it. A top level module with
+        # the same definition as one already registered is not
+        if devices is None:
+            devices = {}
+        devices.setdefault(moduleKey(doc[module]), self)
+
         # Process the module's nodes
         if (doc[module]):
 
             # The module is defined
             self.isDefined = True
 
-            # These are the node we want to have on the python class
-            self.template = collections.OrderedDict([("name",self.name), ("description",""), ("memBase","None"), ("offset",0), ("hidden","False"), ])
-            # And these are the formats we will use to print each node
-            # s: string, us: unquoted string, d: decimal, h: hex
-            self.formats = {"name":'s', "description":'s', "memBase":'us', "offset":'h', "hidden":'us'}
-
-            # These are the nodes we are looking for
-            fields = ["name", "description", "offset"]
-
-            # Look for the nodes on the module and put them on the template
-            for f in fields:
-                if (f in doc[module]):
-                    if (f in doc[module]):
-                        self.template[f] = doc[module][f]
-
-            # If not title was specify, use "PyRogue " + the description found on YAML
-            if not self.title:
-                self.title = "PyRogue %s" % self.template["description"]
-
-            # If not description was specify, use "PyRogue " + the description found on YAML
-            if not self.description:
-                self.description = "PyRogue %s" % self.template["description"]
+            # Look for the module properties
+            self.setProperties(doc[module])
 
             # Now look for children on the module
             if "children" in doc[module]:
@@ -170,131 +812,694 @@ class YamlModule:
                     # Get all the children on the mdules
                     self.yCV = []   # These are Variable children
                     self.yCC = []   # These are Command children
-                    
-                    for var in children:
-                        yc = YamlChild(doc, module, var)
+                    self.yCD = []   # These are Device children
+                    self.yCA = []   # These are bulk array Variable children
 
-                        # Check if this child is a variable
-                        if yc.isVariable:
-                            self.yCV.append(yc)
-                            self.variableCount += 1
-
-                        # Check if this child is a command
-                        if yc.isCommand:
-                            self.yCC.append(yc)
-                            self.commandCount += 1
-
-    # Method to get the equivalent python class
-    def getPyClass(self, file):
+                    for var in children:
+                        self.addChild(children, var, devices)
+
+                    # On batch writes mode, group the writes of the command sequences
+                    if self.options.get("batchWrites"):
+                        variables = dict((yc.name, yc) for yc in self.yCV)
+                        for yc in self.yCC:
+                            yc.setWriteBatches(variables)
+
+                    # On coalesce mode, order the variables by address, so the
+                    # fields sharing a word and the contiguous words are together
+                    if self.options.get("coalesce"):
+                        self.yCV.sort(key=lambda yc: (yc.offset, yc.bitOffset))
+
+        # The structure hash is not needed anymore, and it can't be pickled
+        self.setBaseName()
+
+    # Method to get the module properties from its node
+    def setProperties(self, node):
+        # These are the node we want to have on the python class
+        self.template = collections.OrderedDict([("name",self.name), ("description",""), ("memBase","None"), ("offset",0), ("hidden","False"), ])
+        # And these are the formats we will use to print each node
+        # s: string, us: unquoted string, d: decimal, h: hex
+        self.formats = {"name":'s', "description":'s', "memBase":'us', "offset":'h', "hidden":'us'}
+
+        # These are the nodes we are looking for
+        fields = ["name", "description", "offset"]
+
+        # Look for the nodes on the module and put them on the template
+        for f in fields:
+            if (f in node):
+                self.template[f] = node[f]
+
+        # If not title was specify, use "PyRogue " + the description found on YAML
+        if not self.title:
+            self.title = "PyRogue %s" % self.template["description"]
+
+        # If not description was specify, use "PyRogue " + the description found on YAML
+        if not self.description:
+            self.description = "PyRogue %s" % self.template["description"]
+
+    # Method to process a child of the module. Return the processed child
+    def addChild(self, children, var, devices):
+        # Process YAML's MMIODev classes which map to "Device" in Python
+        if children[var] and children[var].get("class") == "MMIODev":
+            yd = YamlDevice(children, var, self.date, devices, self.options)
+            self.yCD.append(yd)
+            self.deviceCount += 1
+            return yd
+
+        yc = YamlChild(var, children[var])
+
+        # Check if this child is a variable. On bulk arrays mode, the large
+        # arrays are read and written as a block instead
+        if yc.isVariable:
+            if yc.isBulkArray(self.options.get("bulkArrays")):
+                self.yCA.append(yc)
+                self.bulkArrayCount += 1
+            else:
+                self.yCV.append(yc)
+                self.variableCount += 1
+
+            if yc.isEnum:
+                self.enumCount      += 1
+                self.enumValueCount += len(yc.enum)
+
+                if self.options.get("sharedEnums"):
+                    yc.enumName, self.enums[yc.enumName] = getSharedEnum(yc.enum)
+
+            if yc.isArray:
+                self.arrayCount        += 1
+                self.arrayElementCount += yc.number
+
+            if self.options.get("check", True):
+                yc.getBitRanges(self.bitRanges, self.arrayRanges)
+
+        # Check if this child is a command
+        if yc.isCommand:
+            self.yCC.append(yc)
+            self.commandCount += 1
+
+        if self.structure:
+            self.structure.update(repr(yc.getStructure()))
+
+        return yc
+
+    # Method to get the name of the class shared by all the modules with the
+    # same structure, on dedup mode. Only the modules without devices can
+    # share it, as the classes of the devices are defined on the module file.
+    # It is only shared if at least two modules have the same structure
+    def setBaseName(self):
+        if self.structure and self.hasChildren and not self.deviceCount:
+            self.baseName = "Device_%s" % self.structure.hexdigest()[:12]
+        self.structure = None
+
+    # Method to get the file with the class shared by all the modules with the
+    # same structure, used on dedup mode. Its constructor defaults don't depend
+    # on the module, so all the modules get the same file
+    def getPyBaseFile(self):
+        template = collections.OrderedDict(self.template)
+        template["name"]        = self.baseName
+        template["description"] = ""
+        template["offset"]      = 0
+
+        buf = []
+        printSharedHeader(buf, "PyRogue shared device class", "_" + self.baseName,
+                          "Device class shared by the modules with the same structure",
+                          getLicenseHeader(self.options, sleeps=self.hasSleeps()))
+        self.getPyClassBody(buf, self.baseName, template)
+
+        return "".join(buf)
+
+    # Method to know if the command sequences of this module sleep between
+    # their batches of writes, on batch writes mode. If 'devices' is set, the
+    # modules of its devices, defined on the same file, are checked too
+    def hasSleeps(self, devices=False):
+        if not self.hasChildren or not self.options.get("batchWrites"):
+            return False
+        if any(step[0] == "sleep" for yc in self.yCC if yc.batches for step in yc.batches):
+            return True
+        return devices and any(yd.module.hasSleeps(True) for yd in self.yCD)
+
+    # Method to mark a module first processed as a device as a top level module
+    def setTop(self, title, description):
+        self.isTop = True
+        if title:
+            self.title = title
+        if description:
+            self.description = description
+
+    # Method to get the equivalent python class. The classes of the devices
+    # instantiated by this module are printed first, unless they were already
+    # printed or they are top level modules which are printed on their own
+    def getPyClass(self, buf, emitted=None):
+        if emitted is None:
+            emitted = set()
+        emitted.add(self)
 
         # Get the class only if the module is defined
         if self.isDefined:
-
             # Print the file header
-            printHeader(file=file, title=self.title, module=self.name, date=self.date, description=self.description)
-
-            file.write("class %s(pr.Device):\n" % self.name)
-            file.write("%s%s%s\n" % (
-                ' '.ljust(self.identL1),
-                'def __init__('.ljust(self.identL4 - self.identL1),
-                'self,'.ljust(self.identL5 - self.identL4)))
-
-            for node in self.template:
-                if self.formats[node] is 's':
-                    file.write("%s%s%s%s,\n" % (
-                        ' '.ljust(self.identL4),
-                        node.ljust(self.identL5 - self.identL4),
-                        '='.ljust(self.identL6 - self.identL5),
-                        ('\"' + self.template[node] + '\"')))
-                if self.formats[node] is 'us':
-                    file.write("%s%s%s %s,\n" % (
-                        ' '.ljust(self.identL4),
-                        node.ljust(self.identL5 - self.identL4),
-                        '='.ljust(self.identL6 - self.identL5),
-                        self.template[node]))
-                elif self.formats[node] is 'h':
-                    file.write("%s%s%s 0x%02X,\n" % (
-                        ' '.ljust(self.identL4),
-                        node.ljust(self.identL5 - self.identL4),
-                        '='.ljust(self.identL6 - self.identL5),
-                        self.template[node]))
-                elif self.formats[node] is 'd':
-                    file.write("%s%s%s %d,\n" % (
-                        ' '.ljust(self.identL4),
-                        node.ljust(self.identL5 - self.identL4),
-                        '='.ljust(self.identL6 - self.identL5),
-                        self.template[node]))
-
-            file.write("%s):\n" % ' '.ljust(self.identL3))
-
-            file.write("%ssuper(self.__class__, self).__init__(" % (' '.ljust(self.identL2)))
-            for node in self.template:
-                file.write("%s, " % node)
-            file.write(")\n")
-
-            file.write("\n")
-            
-            # Get the variables and commands only if this method has children 
-            if self.hasChildren:
-
-                # If there were variables on this modules, print them
-                if self.variableCount:
-                    file.write("%s##############################\n" % ' '.ljust(self.identL2))
-                    file.write("%s# Variables\n" % ' '.ljust(self.identL2))
-                    file.write("%s##############################\n" % ' '.ljust(self.identL2))
-                    file.write("\n")
-
-                    # For every variable child, call its getPyClass method
-                    for yc in self.yCV:
-                        yc.getPyClass(file)
-
-                # If there were commands on this modules, print them
-                if self.commandCount:
-                    file.write("%s##############################\n" % ' '.ljust(self.identL2))
-                    file.write("%s# Commands\n" % ' '.ljust(self.identL2))
-                    file.write("%s##############################\n" % ' '.ljust(self.identL2))
-                    file.write("\n")
-
-                    # For every command child, call its getPyClass method
-                    for yc in self.yCC:
-                        yc.getPyClass(file)                
+            if self.isTop:
+                printHeader(buf=buf, title=self.title, module=self.name, date=self.date, description=self.description, options=self.options, sleeps=self.hasSleeps(True))
+
+            if self.deviceCount:
+                self.getPyDeviceClasses(buf, emitted)
+
+            # On dedup mode, the class derives from the class shared by all the
+            # modules with the same structure, only setting its own defaults.
+            # Both classes are added, as the shared classes are only known once
+            # all the modules are built
+            if self.baseName:
+                own = []
+                self.getPyClassBody(own, self.name, self.template)
+                derived = [relativeImport("from ._%s import %s" % (self.baseName, self.baseName),
+                                          "from _%s import %s" % (self.baseName, self.baseName)) + "\n"]
+                derived.append("class %s(%s):\n" % (self.name, self.baseName))
+                self.getPyInit(derived)
+                buf.append((self.baseName, "".join(own), "".join(derived)))
+            else:
+                self.getPyClassBody(buf, self.name, self.template)
+
+    # Method to get the class definition with all its children, with the
+    # given class name and constructor defaults
+    def getPyClassBody(self, buf, className, template):
+        buf.append("class %s(pr.Device):\n" % className)
+
+        # On compact mode, the variables are defined on a table
+        if self.variableCount and self.options.get("compact"):
+            self.getPyVariablesTable(buf)
+
+        # On coalesce mode, add the bulk read plan
+        if self.variableCount and self.options.get("coalesce"):
+            self.getPyReadPlan(buf)
+
+        # On bulk arrays mode, add the table of the arrays read and written as a block
+        if self.bulkArrayCount:
+            self.getPyBulkArrays(buf)
+
+        self.getPyInit(buf, className, template)
+
+        # Get the devices, variables and commands only if this method has children
+        if self.hasChildren:
+
+            # If there were devices on this modules, print them
+            if self.deviceCount:
+                self.getPySectionHeader(buf, "Devices")
+                self.getPyDevices(buf)
+
+            # If there were variables on this modules, print them
+            if self.variableCount:
+                self.getPySectionHeader(buf, "Variables")
+                self.getPyVariables(buf)
+
+            # On bulk arrays mode, add the arrays read and written as a block
+            if self.bulkArrayCount:
+                self.getPySectionHeader(buf, "Bulk arrays")
+                buf.append(bulkArraysLoop)
+
+            # If there were commands on this modules, print them
+            if self.commandCount:
+                self.getPySectionHeader(buf, "Commands")
+                self.getPyCommands(buf)
+
+        if self.variableCount and self.options.get("coalesce"):
+            buf.append(readBulkMethod)
+
+        if self.bulkArrayCount:
+            buf.append(bulkArrayMethods)
+
+    # Method to get the classes of the modules instantiated by the devices
+    def getPyDeviceClasses(self, buf, emitted):
+        for yd in self.yCD:
+            if yd.module not in emitted and not yd.module.isTop:
+                yd.module.getPyClass(buf, emitted)
+
+    # Method to get the devices
+    def getPyDevices(self, buf):
+        # For every device child, call its getPyClass method
+        for yd in self.yCD:
+            yd.getPyClass(buf)
+
+    # Method to get the variables
+    def getPyVariables(self, buf):
+        if self.options.get("compact"):
+            # Add the variables defined on the table
+            buf.append(compactVariablesLoop)
+        else:
+            # For every variable child, call its getPyClass method
+            for yc in self.yCV:
+                yc.getPyClass(buf)
+
+    # Method to get the commands
+    def getPyCommands(self, buf):
+        # For every command child, call its getPyClass method
+        for yc in self.yCC:
+            yc.getPyClass(buf)
+
+    # Method to get the address ranges covered by the variables of this module,
+    # as a list of word aligned (start, end) address offsets
+    def getVariableRanges(self):
+        ranges = []
+        for yc in self.yCV:
+            # Word aligned bytes covered by the field
+            start = (yc.offset + yc.bitOffset // 8) & ~3
+            end   = (yc.offset + (yc.bitOffset + yc.bitSize + 7) // 8 + 3) & ~3
+
+            if yc.isArray:
+                for i in range(yc.number):
+                    ranges.append((start + i * yc.stride, end + i * yc.stride))
+            else:
+                ranges.append((start, end))
+
+        return ranges
+
+    # Method to get the bulk read plan of this module: the list of contiguous
+    # (offset, size) address ranges which cover all the variables, each one
+    # no bigger than a transaction
+    def getReadPlan(self):
+        plan = []
+        start = end = None
+        for s, e in sorted(self.getVariableRanges()):
+            if start is not None and s <= end:
+                end = max(end, e)
+                continue
+            if start is not None:
+                plan.append((start, end))
+            start, end = s, e
+        if start is not None:
+            plan.append((start, end))
+
+        # Split the ranges bigger than a transaction
+        readPlan = []
+        for start, end in plan:
+            for offset in range(start, end, maxTransactionSize):
+                readPlan.append((offset, min(end, offset + maxTransactionSize) - offset))
+
+        return readPlan
+
+    # Method to get the bulk read plan, used on coalesce mode
+    def getPyReadPlan(self, buf):
+        L = self.layout
+
+        buf.append("%s# Bulk read plan: contiguous (offset, size) address ranges covering all the variables\n" % L.indent[1])
+        buf.append("%s_readPlan = (\n" % L.indent[1])
+        for offset, size in self.getReadPlan():
+            buf.append("%s(0x%02X, 0x%02X),\n" % (L.indent[2], offset, size))
+        buf.append("%s)\n\n" % L.indent[1])
+
+    # Method to add the address index entries of the variables of this module,
+    # and of the devices it instantiates, to a list. The names start with the
+    # prefix, and the offsets with the base offset
+    def getIndexEntries(self, entries, prefix, base):
+        if not self.hasChildren:
+            return
+
+        for yc in self.yCV + self.yCA:
+            entries.append((prefix + yc.name, base + yc.offset, yc.bitOffset, yc.bitSize, yc.number, yc.stride, yc.mode, yc.enum))
+
+        for yd in self.yCD:
+            if yd.isArray:
+                for i in range(yd.number):
+                    yd.module.getIndexEntries(entries, "%s%s[%d]." % (prefix, yd.name, i), base + yd.offset + i * yd.stride)
+            else:
+                yd.module.getIndexEntries(entries, "%s%s." % (prefix, yd.name), base + yd.offset)
+
+    # Method to check the address map of the module. The bit ranges of the
+    # variables are sorted and merged with the ones of the array elements,
+    # which are generated in order from the range of each array instead of
+    # being kept, and then swept once. The ranges still reaching the current
+    # one are kept on a heap by their end, so each range is compared only
+    # with the ones it overlaps, and the check takes O(n log n) instead of
+    # comparing every pair. Return the overlapping pairs of variables and the
+    # misaligned ones (crossing a word boundary), up to the number reported,
+    # their total numbers, and the number of gaps between variables and the
+    # bits they leave unused.
+    def getAddressCheck(self):
+        if self.addressCheck is not None:
+            return self.addressCheck
+
+        overlaps     = []
+        overlapCount = 0
+        misaligned   = []
+        misalignedCount = 0
+        gaps         = 0
+        gapBits      = 0
+
+        self.bitRanges.sort()
+        ranges = heapq.merge(self.bitRanges, *[arrayBitRanges(r) for r in self.arrayRanges])
+
+        active = []
+        last   = None
+        for r in ranges:
+            start, end = r[0], r[1]
+
+            while active and active[0][0] <= start:
+                heapq.heappop(active)
+
+            if active:
+                overlapCount += len(active)
+                for other in active[:maxCheckReports - len(overlaps)]:
+                    overlaps.append((r, other[1]))
+            elif last is not None and start > last:
+                gaps    += 1
+                gapBits += start - last
+
+            # Variables up to a word wide must be in a single word, wider ones
+            # must start on a word boundary
+            if (end - start <= 32 and start // 32 != (end - 1) // 32) or (end - start > 32 and start % 32):
+                misalignedCount += 1
+                if len(misaligned) < maxCheckReports:
+                    misaligned.append(r)
+
+            heapq.heappush(active, (end, r))
+            if last is None or end > last:
+                last = end
+
+        # The bit ranges are not needed anymore
+        self.bitRanges    = []
+        self.arrayRanges  = []
+        self.addressCheck = (overlaps, overlapCount, misaligned, misalignedCount, gaps, gapBits)
+
+        return self.addressCheck
+
+    # Method to get the conversion report lines of this module, given the
+    # names of the shared classes on dedup mode
+    def getReport(self, report, shared=()):
+        if self.baseName in shared:
+            report.append("%s: derived from %s, shared by the modules with the same structure" % (self.name, self.baseName))
+
+        if self.isDefined and (self.variableCount or self.bulkArrayCount) and self.options.get("check", True):
+            overlaps, overlapCount, misaligned, misalignedCount, gaps, gapBits = self.getAddressCheck()
+            for r, other in overlaps:
+                report.append("%s: warning: %s (%s) overlaps %s (%s)" % (
+                    self.name, bitRangeName(r), bitRangeText(r), bitRangeName(other), bitRangeText(other)))
+            if overlapCount > len(overlaps):
+                report.append("%s: warning: %d more overlaps" % (self.name, overlapCount - len(overlaps)))
+            for r in misaligned:
+                report.append("%s: warning: %s (%s) crosses a word boundary" % (self.name, bitRangeName(r), bitRangeText(r)))
+            if misalignedCount > len(misaligned):
+                report.append("%s: warning: %d more misaligned variables" % (self.name, misalignedCount - len(misaligned)))
+            if gaps:
+                report.append("%s: %d gaps between variables, %d bits unused" % (self.name, gaps, gapBits))
+
+        if self.isDefined and self.variableCount and self.options.get("coalesce"):
+            report.append("%s: %d transactions to read the variables one by one, %d using the bulk read plan" % (
+                self.name, len(self.getVariableRanges()), len(self.getReadPlan())))
+
+        if self.isDefined and self.commandCount and self.options.get("batchWrites"):
+            for yc in self.yCC:
+                report.append("%s.%s: %d writes committed in %d block writes" % (
+                    self.name, yc.name, yc.getWriteCount(), yc.getBlockWriteCount()))
+
+    # Method to add the counts of this module to the statistics
+    def getStats(self, stats):
+        if not self.isDefined:
+            return
+
+        stats["modules"]   += 1
+        stats["variables"] += self.variableCount + self.bulkArrayCount
+        stats["commands"]  += self.commandCount
+        stats["devices"]   += self.deviceCount
+
+        stats["enums"]         += self.enumCount
+        stats["enumValues"]    += self.enumValueCount
+        stats["arrays"]        += self.arrayCount
+        stats["arrayElements"] += self.arrayElementCount
+        stats["bulkArrays"]    += self.bulkArrayCount
+
+        if (self.variableCount or self.bulkArrayCount) and self.options.get("check", True):
+            overlaps, overlapCount, misaligned, misalignedCount, gaps, gapBits = self.getAddressCheck()
+            stats["overlaps"]   += overlapCount
+            stats["misaligned"] += misalignedCount
+            stats["gaps"]       += gaps
+
+    # Method to get the class constructor, up to the call to the parent constructor.
+    # The parent class is named explicitly, as "self.__class__" would call this
+    # same constructor again from the constructor of a derived class
+    def getPyInit(self, buf, className=None, template=None):
+        L = self.layout
+
+        if className is None:
+            className = self.name
+        if template is None:
+            template = self.template
+
+        buf.append("%s%s\n" % (L.field('def __init__(', 1, 4), L.label('self,', 4, 5)))
+
+        for node in template:
+            prefix = L.field(node, 4, 5) + L.label('=', 5, 6)
+            if self.formats[node] == 's':
+                buf.append("%s\"%s\",\n" % (prefix, template[node]))
+            elif self.formats[node] == 'us':
+                buf.append("%s %s,\n" % (prefix, template[node]))
+            elif self.formats[node] == 'h':
+                buf.append("%s 0x%02X,\n" % (prefix, template[node]))
+            elif self.formats[node] == 'd':
+                buf.append("%s %d,\n" % (prefix, template[node]))
+
+        buf.append("%s):\n" % L.indent[3])
+
+        buf.append("%ssuper(%s, self).__init__(%s)\n" % (L.indent[2], className, "".join("%s, " % node for node in template)))
+
+        buf.append("\n")
+
+    # Method to get the table with the variables definitions, used on compact mode
+    def getPyVariablesTable(self, buf, variables=None):
+        L = self.layout
+
+        buf.append("%s# (name, description, offset, bitSize, bitOffset, base, mode, enum, number, stride)\n" % L.indent[1])
+        buf.append("%s_variables = (\n" % L.indent[1])
+        self.getPyVariableRows(buf, self.yCV if variables is None else variables)
+        buf.append("%s)\n\n" % L.indent[1])
+
+    # Method to get the rows of the variables table
+    def getPyVariableRows(self, buf, variables):
+        for yc in variables:
+            yc.getPyVariableRow(buf)
+
+    # Method to get the table with the arrays read and written as a block,
+    # used on bulk arrays mode
+    def getPyBulkArrays(self, buf):
+        L = self.layout
+
+        buf.append("%s# Arrays read and written as a block, by name: (offset, number, stride, bitSize, bitOffset, mode, description)\n" % L.indent[1])
+        buf.append("%s_bulkArrays = {\n" % L.indent[1])
+        self.getPyBulkArrayRows(buf)
+        buf.append("%s}\n\n" % L.indent[1])
+
+    # Method to get the rows of the bulk arrays table
+    def getPyBulkArrayRows(self, buf):
+        for yc in self.yCA:
+            yc.getPyBulkArrayRow(buf)
+
+    # Method to get the equivalent python package, used on split mode. The class
+    # is written on the package "__init__.py" (on 'buf') but its variables and
+    # devices are written on their own files of the package (on 'files'), in
+    # groups which are imported and built by the constructor. On lazy mode,
+    # each group is only imported and built the first time one of its
+    # children is accessed
+    def getPyPackage(self, buf, files, emitted):
+        emitted.add(self)
 
-# Method to process one child of the module on the YAML file
-class YamlChild:
-    def __init__(self, doc, module, var):
-        # Indentation levels
-        #-------------------------------------------------->|<- L5
-        #------------------------------------------->|<-L4  |
-        #------------------------------>|<-L3        |      |
-        #---------------------->|<-L2   |            |      |
-        #-->|<-L1               |       |            |      |
-        #   |self.addCommand(   |       |name        |=     |'name',
-        #   |                   |       |function    |=     |"""\
-        #   |                   |       |            |      | entry(value)
-        #   |                   |       |            |      | """
-        #   |                   |)      |            |      |
-        #   |                   |       |            |      |
-        #   |self.addVariable(  |       |name        |=     |'name',
-        #   |                   |       |description |=     |'description',
-        #   |                   |       |enum        |=     |{
-        #   |                   |       |            |      |    |0 : "Zero"
-        #   |                   |       |            |      |}   |
-        #   |                   |)                               |
-        #---------------------------------------------------->|<-L6
-        #
-        self.identL1 = 8
-        self.identL2 = 24
-        self.identL3 = 28
-        self.identL4 = 41
-        self.identL5 = 43
-        self.identL6 = 46
+        # Get the class only if the module is defined
+        if not self.isDefined:
+            return
+
+        L = self.layout
+        splitSize = self.options["split"]
+        lazy      = self.options.get("lazy")
+
+        # The classes of the devices go to their own files
+        if self.deviceCount:
+            for yd in self.yCD:
+                if not yd.module.isTop:
+                    yd.module.getPyClassFile(files, emitted)
+
+        # Group the children. Each group is written on its own file, which
+        # builds the group children when the group is loaded
+        groups       = []
+        lazyChildren = []
+        if self.deviceCount:
+            for yd in self.yCD:
+                group = "_%s_%s" % (self.name, yd.name)
+
+                g = [getLicenseHeader(self.options, True), yd.module.getPyImport()]
+                g.append("\ndef build(self):\n")
+                yb = []
+                yd.getPyClass(yb)
+                g.append(dedent("".join(yb)))
+                files[group + ".py"] = "".join(g)
+
+                groups.append(group)
+                lazyChildren.append((yd.name, group))
+                if yd.isArray:
+                    for i in range(yd.number):
+                        lazyChildren.append(("%s[%d]" % (yd.name, i), group))
+
+        if self.variableCount:
+            for n in range(0, self.variableCount, splitSize):
+                group = "_%sVariables%d" % (self.name, n // splitSize)
+                variables = self.yCV[n:n + splitSize]
+
+                g = [getLicenseHeader(self.options, True)]
+                yb = []
+                if self.options.get("compact"):
+                    self.getPyVariablesTable(yb, variables)
+                    yb.append("    def build(self):\n")
+                    yb.append(compactVariablesLoop.replace("self._variables", "_variables"))
+                else:
+                    yb.append("    def build(self):\n")
+                    for yc in variables:
+                        yc.getPyClass(yb)
+                g.append(dedent("".join(yb)))
+                files[group + ".py"] = "".join(g)
+
+                groups.append(group)
+                for yc in variables:
+                    lazyChildren.append((yc.name, group))
+
+        # Print the file header
+        if self.isTop:
+            printHeader(buf=buf, title=self.title, module=self.name, date=self.date, description=self.description, options=self.options, package=True, sleeps=self.hasSleeps())
+        buf.append("import importlib\n\n")
+
+        buf.append("class %s(pr.Device):\n" % self.name)
+
+        if lazy:
+            # Map of the children built on first access to the group building them
+            buf.append("%s# Children built the first time they are accessed, and the group building them\n" % L.indent[1])
+            buf.append("%s_lazyChildren = {\n" % L.indent[1])
+            for name, group in lazyChildren:
+                buf.append("%s\"%s\" : \"%s\",\n" % (L.indent[2], name, group))
+            buf.append("%s}\n\n" % L.indent[1])
+        else:
+            # Groups building the children, in order
+            buf.append("%s# Files of the package building the children, in order\n" % L.indent[1])
+            buf.append("%s_groups = (\n" % L.indent[1])
+            for group in groups:
+                buf.append("%s\"%s\",\n" % (L.indent[2], group))
+            buf.append("%s)\n\n" % L.indent[1])
+
+        # On coalesce mode, add the bulk read plan
+        if self.variableCount and self.options.get("coalesce"):
+            self.getPyReadPlan(buf)
+
+        # On bulk arrays mode, add the table of the arrays read and written as a block
+        if self.bulkArrayCount:
+            self.getPyBulkArrays(buf)
+
+        self.getPyInit(buf)
+
+        if lazy:
+            buf.append("%sself._lazyLoaded = set()\n\n" % L.indent[2])
+        elif groups:
+            self.getPySectionHeader(buf, "Devices and variables")
+            buf.append(groupsLoop)
+
+        # The bulk arrays are added by the constructor, as they are defined
+        # on the class
+        if self.bulkArrayCount:
+            self.getPySectionHeader(buf, "Bulk arrays")
+            buf.append(bulkArraysLoop)
+
+        # Commands are kept on the class
+        if self.commandCount:
+            self.getPySectionHeader(buf, "Commands")
+
+            for yc in self.yCC:
+                yc.getPyClass(buf)
+
+        if lazy:
+            buf.append(lazyMethods % {"name": self.name})
+
+        if self.variableCount and self.options.get("coalesce"):
+            buf.append(readBulkMethod)
+
+        if self.bulkArrayCount:
+            buf.append(bulkArrayMethods)
+
+    # Method to write the class of this module on its own file of the package,
+    # used on split mode for the modules instantiated as devices
+    def getPyClassFile(self, files, emitted):
+        if self in emitted:
+            return
+        emitted.add(self)
+
+        # The classes of the devices go to their own files too
+        imports = []
+        if self.deviceCount:
+            for yd in self.yCD:
+                if not yd.module.isTop:
+                    yd.module.getPyClassFile(files, emitted)
+                imports.append(yd.module.getPyImport())
+
+        buf = [getLicenseHeader(self.options, True, self.hasSleeps())]
+        buf.extend(sorted(set(imports)))
+        buf.append("\n")
+
+        self.getPyClass(buf, emitted)
+
+        files["_%s.py" % self.name] = "".join(buf)
+
+    # Method to get the import statement of the class of this module from
+    # other file of the package, used on split mode
+    def getPyImport(self):
+        if self.isTop:
+            return "from . import %s\n" % self.name
+        return "from ._%s import %s\n" % (self.name, self.name)
+
+    # Method to get the header of a section of the class
+    def getPySectionHeader(self, buf, section):
+        indent = self.layout.indent[2]
+        buf.append("%s##############################\n%s# %s\n%s##############################\n\n" % (indent, indent, section, indent))
 
+# Method to process one child of the module on the YAML file
+class YamlChild(object):
+    # Indentation levels
+    #-------------------------------------------------->|<- L5
+    #------------------------------------------->|<-L4  |
+    #------------------------------>|<-L3        |      |
+    #---------------------->|<-L2   |            |      |
+    #-->|<-L1               |       |            |      |
+    #   |self.addCommand(   |       |name        |=     |'name',
+    #   |                   |       |function    |=     |"""\
+    #   |                   |       |            |      | entry(value)
+    #   |                   |       |            |      | """
+    #   |                   |)      |            |      |
+    #   |                   |       |            |      |
+    #   |self.addVariable(  |       |name        |=     |'name',
+    #   |                   |       |description |=     |'description',
+    #   |                   |       |enum        |=     |{
+    #   |                   |       |            |      |    |0 : "Zero"
+    #   |                   |       |            |      |}   |
+    #   |                   |)                               |
+    #---------------------------------------------------->|<-L6
+    #
+    layout = Layout({1:8, 2:24, 3:28, 4:41, 5:43, 6:46})
+
+    # Format strings used to print the variables, by variable properties
+    variableFormats = {}
+
+    # Properties of the python class, in order, and the formats we will use
+    # to print them. s: string, h: hex, d: decimal
+    variableNodes = ("description", "offset", "bitSize", "bitOffset", "base", "mode")
+    arrayNodes    = variableNodes + ("number", "stride")
+    commandNodes  = ("description",)
+    nodeFormats   = {"description":'s', "offset":'h', "bitSize":'d', "bitOffset":'h', "base":'s', "mode":'s', "number":'d', "stride":'d'}
+
+    # Children are kept for the whole conversion, and big register maps
+    # have a lot of them, so only the extracted values are stored, on slots
+    # instead of a per instance dictionary
+    __slots__ = ("name", "isVariable", "isCommand", "isEnum", "isArray", "nodes",
+                 "description", "offset", "bitSize", "bitOffset", "base", "mode", "number", "stride",
+                 "enum", "enumName", "seq", "batches")
+
+    def __init__(self, var, node):
         # Type of child (Only Variable and Command are supported)
         self.isVariable = False
         self.isCommand  = False
 
-        # Variable of ENUM type
-        self.isEnum = False
+        # Variable of ENUM type, and the name of its shared enum table
+        self.isEnum   = False
+        self.enum     = None
+        self.enumName = None
 
         # Array of variables
         self.isArray = False
@@ -303,7 +1508,7 @@ class YamlChild:
         self.name = var
 
         # Get the child class
-        yClass = doc[module]["children"][var]["class"]
+        yClass = node["class"]
 
         # Process YAML's IntField classes which map to "Variable" in Python
         if yClass == "IntField":
@@ -311,50 +1516,36 @@ class YamlChild:
             # This child is a Variable
             self.isVariable = True
 
-            # These are the node we want to have on the python class
-            self.template = collections.OrderedDict([("description",""),("offset",0),("bitSize",32),("bitOffset",0),("base","hex"),("mode","RO")])
-            # And these are the formats we will use to print each node
-            self.formats = {"description":'s', "offset":'h', "bitSize":'d', "bitOffset":'h', "base":'s', "mode":'s', "number":'d', "stride":'d'}
-
-            # These are the nodes we are looking for in the child
-            var_fields = ["description", "sizeBits", "base", "mode", "lsBit"]
-            # These are the map between this YAML nodes name to Python node name
-            cpsw_rogue_var_field_name_dict = {"description":"description", "sizeBits":"bitSize", "base":"base", "mode":"mode", "lsBit":"bitOffset"}
-
-            # These are the nodes we are looking for under the "at" container
-            var_at_fields = ["offset", "nelms", "stride"]
-            # These are the map between this YAML nodes name to Python node name
-            cpsw_rogue_var_at_field_name_dict = {"offset":"offset", "nelms":"number", "stride":"stride"}
-
-            # Look for the node under "at" and put then on the template
-            for vaf in var_at_fields:
-                if (vaf in doc[module]["children"][var]["at"]):
-                    self.template[cpsw_rogue_var_at_field_name_dict[vaf]] = doc[module]["children"][var]["at"][vaf]
-                
-            # Look for the child's node and put them on the template
-            for vf in var_fields:
-                if (vf in doc[module]["children"][var]):
-                    self.template[cpsw_rogue_var_field_name_dict[vf]] = doc[module]["children"][var][vf]
+            # Look for the nodes on the child, and under the "at" container.
+            # Use the PyRogue default value for the ones not found
+            at = node["at"]
+            self.description = node.get("description", "")
+            self.offset      = at.get("offset", 0)
+            self.bitSize     = node.get("sizeBits", 32)
+            self.bitOffset   = node.get("lsBit", 0)
+            self.base        = node.get("base", "hex")
+            self.mode        = node.get("mode", "RO")
 
             # Check if this variable is of ENUM type
-            if ("enums" in doc[module]["children"][var]):
+            yEnum = node.get("enums")
+            if yEnum is not None:
                 self.isEnum = True
-                self.enum = []
-                self.template["base"] = "enum"
-                yEnum = doc[module]["children"][var]["enums"]
-                for i in range(len(yEnum)):
-                    self.enum.append((yEnum[i]["value"], yEnum[i]["name"]))
+                self.base   = "enum"
+                self.enum   = tuple((e["value"], e["name"]) for e in yEnum)
 
             # Check if this is an array of variables
-            if ("nelms" in doc[module]["children"][var]["at"]):
+            if "nelms" in at:
                 self.isArray = True
+                self.nodes   = self.arrayNodes
+                self.number  = at["nelms"]
 
                 # 'stride' is optional on YAML but mandatory on PyRogue
                 # So let's ckeck if it was present on YAML. If not, use 4 as default
-                if ("stride" not in doc[module]["children"][var]["at"]):
-                    self.template["stride"] = 4
-
-
+                self.stride = at.get("stride", 4)
+            else:
+                self.nodes  = self.variableNodes
+                self.number = None
+                self.stride = None
 
         # Process YAML's SequenceCommand classes which map to "Command" in Python
         if yClass == "SequenceCommand":
@@ -362,103 +1553,1689 @@ class YamlChild:
             # This Child is a Command
             self.isCommand = True
 
-            # These are the nodes we are looking for
-            self.template = collections.OrderedDict([("description","")])
+            # Look for the nodes on the child
+            self.nodes       = self.commandNodes
+            self.description = node.get("description", "")
+
+            # Command sequence writes grouped in batches, on batch writes mode
+            self.batches = None
 
-            # Look for the nodes on the module and put them on the template
-            for f in self.template:
-                if (f in doc[module]["children"][var]):
-                    self.template[f] = doc[module]["children"][var][f]
-            
             # Read the command sequence
-            self.seq = []
-            ySeq = doc[module]["children"][var]["sequence"]
-            for i in range(len(ySeq)):
-                self.seq.append((ySeq[i]["entry"], ySeq[i]["value"]))
+            self.seq = tuple((e["entry"], e["value"]) for e in node["sequence"])
 
     # Method to get the equivalent python class
-    def getPyClass (self, file):
+    def getPyClass (self, buf):
         if self.isVariable:
-            self.getPyVariablesClass(file)
+            self.getPyVariablesClass(buf)
 
         if self.isCommand:
-            self.getPyCommandsClass(file)
+            self.getPyCommandsClass(buf)
 
     # Method to get the equivalent python class for Variables (IntFields)
-    def getPyVariablesClass(self, file):
-        # Print the variable definition line
-        file.write("%s%s%s= \"%s\",\n" % (
-            ' '.ljust(self.identL1), 
-            ('self.addVariable' + ('s' if self.isArray else '') + '(').ljust(self.identL3 - self.identL1),
-            'name'.ljust(self.identL4 - self.identL3), 
-            self.name))
-
-        # Print the variable properties
-        for node in self.template:
-            if self.formats[node] is 's':
-                file.write("%s%s= \"%s\",\n" % (
-                    ' '.ljust(self.identL3), 
-                    node.ljust(self.identL4 - self.identL3), 
-                    self.template[node]))
-            elif self.formats[node] is 'h':
-                file.write("%s%s=  0x%02X,\n" % (
-                    ' '.ljust(self.identL3), 
-                    node.ljust(self.identL4 - self.identL3), 
-                    self.template[node]))
-            else:
-                file.write("%s%s=  %d,\n" % (
-                    ' '.ljust(self.identL3),
-                    node.ljust(self.identL4 - self.identL3), 
-                    self.template[node]))
-        
-        # Print the ENUM dictionary for ENUM type variables
-        if self.isEnum:
-            file.write("%s%s= {\n" % (' '.ljust(self.identL3), "enum".ljust(self.identL4 - self.identL3)))
-            for i in range(len(self.enum)):
-                file.write("%s%d : \"%s\",\n" % (' '.ljust(self.identL6), self.enum[i][0], self.enum[i][1]))
-            file.write("%s},\n" % ' '.ljust(self.identL5))
+    def getPyVariablesClass(self, buf):
+        L = self.layout
+
+        # Print the variable definition line and the variable properties.
+        # All the variables with the same properties share the same format
+        try:
+            fmt = self.variableFormats[self.nodes]
+        except KeyError:
+            fmt = self.variableFormats[self.nodes] = self.getVariableFormat()
+
+        buf.append(fmt % ((self.name,) + tuple([getattr(self, node) for node in self.nodes])))
+
+        # Print the ENUM dictionary for ENUM type variables, or the shared
+        # enum table on shared enums mode
+        if self.enumName:
+            buf.append("%s=  %s.%s,\n" % (L.field("enum", 3, 4), enumsModule, self.enumName))
+        elif self.isEnum:
+            buf.append("%s= {\n" % L.field("enum", 3, 4))
+            for value, name in self.enum:
+                buf.append("%s%d : \"%s\",\n" % (L.indent[6], value, name))
+            buf.append("%s},\n" % L.indent[5])
 
         # Print the end of variable elements
-        file.write("%s)\n" % ' '.ljust(self.identL2))
-        file.write("\n")
+        buf.append("%s)\n\n" % L.indent[2])
+
+    # Method to build the format string used to print the variable definition
+    # line and the variable properties
+    def getVariableFormat(self):
+        L = self.layout
+
+        fmt = ["%s%s= \"%%s\",\n" % (
+            L.field('self.addVariables(' if self.isArray else 'self.addVariable(', 1, 3),
+            L.label('name', 3, 4))]
+
+        for node in self.nodes:
+            if self.nodeFormats[node] == 's':
+                fmt.append("%s= \"%%s\",\n" % L.field(node, 3, 4))
+            elif self.nodeFormats[node] == 'h':
+                fmt.append("%s=  0x%%02X,\n" % L.field(node, 3, 4))
+            else:
+                fmt.append("%s=  %%d,\n" % L.field(node, 3, 4))
+
+        return "".join(fmt)
+
+    # Method to get the row of the variables table used on compact mode
+    def getPyVariableRow(self, buf):
+        if self.enumName:
+            enum = "%s.%s" % (enumsModule, self.enumName)
+        elif self.isEnum:
+            enum = "{%s}" % ", ".join("%d:\"%s\"" % (value, name) for value, name in self.enum)
+        else:
+            enum = "None"
+
+        if self.isArray:
+            array = "%d, %d" % (self.number, self.stride)
+        else:
+            array = "None, None"
+
+        buf.append("%s(\"%s\", \"%s\", 0x%02X, %d, %d, \"%s\", \"%s\", %s, %s),\n" % (
+            self.layout.indent[1], self.name, self.description, self.offset, self.bitSize, self.bitOffset,
+            self.base, self.mode, enum, array))
+
+    # Method to know if the variable is an array to be read and written as a
+    # block, on bulk arrays mode: a word aligned array of at least 'minElements'
+    # elements, with each element within its own word, one after the other.
+    # With a bigger stride, writing the region would write the words between
+    # the elements too
+    def isBulkArray(self, minElements):
+        return (bool(minElements) and self.isArray and self.number >= minElements and
+                self.offset % 4 == 0 and self.stride == 4 and self.bitOffset + self.bitSize <= 32)
+
+    # Method to get the row of the bulk arrays table used on bulk arrays mode
+    def getPyBulkArrayRow(self, buf):
+        buf.append("%s\"%s\" : (0x%02X, %d, %d, %d, %d, \"%s\", \"%s\"),\n" % (
+            self.layout.indent[1], self.name, self.offset, self.number, self.stride, self.bitSize, self.bitOffset,
+            self.mode, self.description))
+
+    # Method to get the absolute bit range (first bit, last bit + 1) of a variable
+    def getBitRange(self):
+        start = self.offset * 8 + self.bitOffset
+        return (start, start + self.bitSize)
+
+    # Method to get the structure of the child: everything written on its code
+    def getStructure(self):
+        if self.isVariable:
+            enum = tuple([(value, "%s" % name) for value, name in self.enum]) if self.isEnum else None
+            return ("variable", self.name, self.description, self.offset, self.bitSize, self.bitOffset,
+                    self.base, self.mode, self.number, self.stride, enum)
+        if self.isCommand:
+            return ("command", self.name, self.description, self.seq)
+        return ("other", self.name)
+
+    # Method to add the bit range of the variable to a list, as a (first bit,
+    # last bit + 1, name, None) tuple. Arrays are added to the arrays list
+    # instead, as a single (first bit, last bit + 1, name, number of elements,
+    # stride in bits) tuple with the range of the first element
+    def getBitRanges(self, ranges, arrays):
+        start, end = self.getBitRange()
+        if self.isArray:
+            arrays.append((start, end, self.name, self.number, self.stride * 8))
+        else:
+            ranges.append((start, end, self.name, None))
+
+    # Method to group the writes of the command sequence in batches, used on
+    # batch writes mode. The writes of a batch are staged and then committed
+    # together, so the writes to the same or next-door words go in the same
+    # writeBlocks call. PyRogue writes the blocks of a call in address order,
+    # so a write only joins the current batch if it goes to the same words
+    # as the previous write of the batch or to the next word, without
+    # touching bits already staged: a sequence going back to an earlier word
+    # (or writing the same bits twice) starts a new batch, to keep the order
+    # the sequence requires. Sleeps and writes to unknown entries are not
+    # batched. Each batch keeps the number of different words it writes.
+    def setWriteBatches(self, variables):
+        self.batches = []
+        batch  = []
+        staged = []
+        words  = None
+        for entry, value in self.seq:
+            yc = variables.get(entry)
+
+            if entry == "usleep":
+                step = ("sleep", value)
+            elif yc is None or yc.isArray:
+                step = ("set", entry, value)
+            else:
+                bits = yc.getBitRange()
+                span = (bits[0] // 32, (bits[1] - 1) // 32)
+                if batch and (span[0] < words[0] or span[0] > words[1] + 1 or
+                              any(bits[0] < e and s < bits[1] for s, e in staged)):
+                    self.batches.append(("batch", batch, len(set(s // 32 for s, e in staged))))
+                    batch  = []
+                    staged = []
+                batch.append((entry, value))
+                staged.append(bits)
+                words = span
+                continue
+
+            if batch:
+                self.batches.append(("batch", batch, len(set(s // 32 for s, e in staged))))
+                batch  = []
+                staged = []
+            self.batches.append(step)
+
+        if batch:
+            self.batches.append(("batch", batch, len(set(s // 32 for s, e in staged))))
+
+    # Method to get the number of writes of the command sequence
+    def getWriteCount(self):
+        return len([entry for entry, value in self.seq if entry != "usleep"])
+
+    # Method to get the number of block writes of the command sequence, used
+    # on batch writes mode: one for each word written by each batch, and one
+    # for each write not batched
+    def getBlockWriteCount(self):
+        return sum(step[2] if step[0] == "batch" else 1 for step in self.batches if step[0] != "sleep")
+
+    # Method to get the command sequence with the writes in batches, used on batch writes mode
+    def getPyWriteBatches(self, buf):
+        indent = self.layout.indent[5]
+        for step in self.batches:
+            if step[0] == "sleep":
+                buf.append("%stime.sleep(%r)\n" % (indent, step[1] / 1e6))
+            elif step[0] == "set" or len(step[1]) == 1:
+                entry, value = step[1:] if step[0] == "set" else step[1][0]
+                buf.append("%sself.%s.set(%d)\n" % (indent, entry, value))
+            else:
+                for entry, value in step[1]:
+                    buf.append("%sself.%s.set(%d, write=False)\n" % (indent, entry, value))
+                variables = ", ".join("self.%s" % entry for entry, value in step[1])
+                buf.append("%sself.writeBlocks(variable=[%s])\n" % (indent, variables))
+                buf.append("%sself.checkBlocks(variable=[%s])\n" % (indent, variables))
 
     # Method to get the equivalent python class for Commands (SequenceCommand)
-    def getPyCommandsClass(self, file):
+    def getPyCommandsClass(self, buf):
+        L = self.layout
+
         # Printf the comamnd definition line
-        file.write("%s%s%s= \"%s\",\n" % (
-            ' '.ljust(self.identL1), 
-            'self.addCommand('.ljust(self.identL3 - self.identL1), 
-            'name'.ljust(self.identL4 - self.identL3), 
+        buf.append("%s%s= \"%s\",\n" % (
+            L.field('self.addCommand(', 1, 3),
+            L.label('name', 3, 4),
             self.name))
 
         # Print the command properties
-        for node in self.template:
-            file.write("%s%s= \"%s\",\n" % (
-                ' '.ljust(self.identL3), 
-                node.ljust(self.identL4 - self.identL3), 
-                self.template[node]))
+        for node in self.nodes:
+            buf.append("%s= \"%s\",\n" % (L.field(node, 3, 4), getattr(self, node)))
 
         # Print the command sequence
-        file.write("%s%s= \"\"\"\\\n" % (
-            ' '.ljust(self.identL3), 
-            'function'.ljust(self.identL4 - self.identL3)))
-        
-        for i in range(len(self.seq)):
-            file.write("%sself.%s.set(%d)\n" % (' '.ljust(self.identL5), self.seq[i][0], self.seq[i][1]))
+        buf.append("%s= \"\"\"\\\n" % L.field('function', 3, 4))
 
-        file.write("%s\"\"\"\n" % (' '.ljust(self.identL5)))
+        if self.batches is not None:
+            self.getPyWriteBatches(buf)
+        else:
+            for entry, value in self.seq:
+                buf.append("%sself.%s.set(%d)\n" % (L.indent[5], entry, value))
+
+        buf.append("%s\"\"\"\n" % L.indent[5])
 
         # Print the end of commands elements
-        file.write("%s)\n" % ' '.ljust(self.identL2))
-        file.write("\n")
+        buf.append("%s)\n\n" % L.indent[2])
+
+# Maximum size, in bytes, of a transaction of the bulk read plan
+maxTransactionSize = 4096
+
+# Method reading the whole device following the bulk read plan, used on coalesce mode
+readBulkMethod = """\
+    # Read the whole device with the fewest transactions, following the
+    # bulk read plan. Return the raw words read, by address offset. The
+    # variables are not updated: it doesn't replace readBlocks/checkBlocks
+    def readBulk(self):
+        data = {}
+        for offset, size in self._readPlan:
+            words = self._rawRead(offset, size // 4)
+            if not isinstance(words, list):
+                words = [words]
+            for i, word in enumerate(words):
+                data[offset + 4 * i] = word
+        return data
+
+"""
+
+# Methods reading and writing the arrays of the bulk arrays table, used on bulk
+# arrays mode. The whole region of an array is moved on transactions of up to
+# maxTransactionSize bytes, into a numpy array, instead of one transaction
+# for each element
+bulkArrayMethods = """\
+    # Read the words of the region of a bulk array
+    def _readArrayWords(self, offset, size):
+        words = numpy.empty(size, dtype=numpy.uint32)
+        for i in range(0, size, %(maxWords)d):
+            data = self._rawRead(offset + 4 * i, min(size - i, %(maxWords)d))
+            if not isinstance(data, list):
+                data = [data]
+            words[i:i + len(data)] = data
+        return words
+
+    # Read a bulk array. Return its elements as a numpy array
+    def readArray(self, name):
+        offset, number, stride, bitSize, bitOffset, mode, description = self._bulkArrays[name]
+        if mode == "WO":
+            raise ValueError("Array \\"%%s\\" is write only" %% name)
+
+        values = self._readArrayWords(offset, number)
+        if bitSize < 32:
+            values = (values >> bitOffset) & ((1 << bitSize) - 1)
+        return values
+
+    # Write a bulk array, from a sequence with a value for each element or a
+    # single value for all of them. If the elements are narrower than a word,
+    # the words are read first, so the bits of the other fields are written
+    # back; that is not possible on write only arrays
+    def writeArray(self, name, values):
+        offset, number, stride, bitSize, bitOffset, mode, description = self._bulkArrays[name]
+        if mode == "RO":
+            raise ValueError("Array \\"%%s\\" is read only" %% name)
+
+        values = numpy.zeros(number, dtype=numpy.uint32) + numpy.asarray(values, dtype=numpy.uint32)
+        if bitSize == 32:
+            words = values
+        elif mode == "WO":
+            raise ValueError("Array \\"%%s\\" is write only and narrower than a word, its other bits can't be kept" %% name)
+        else:
+            mask  = numpy.uint32(((1 << bitSize) - 1) << bitOffset)
+            words = self._readArrayWords(offset, number)
+            words = (words & ~mask) | ((values << bitOffset) & mask)
+
+        for i in range(0, number, %(maxWords)d):
+            self._rawWrite(offset + 4 * i, words[i:i + %(maxWords)d].tolist())
+
+""" % {"maxWords": maxTransactionSize // 4}
+
+# Loop adding a local variable for each bulk array, used on bulk arrays mode,
+# so they are part of the variable tree. They are read and written as a block
+bulkArraysLoop = """\
+        for name in sorted(self._bulkArrays):
+            offset, number, stride, bitSize, bitOffset, mode, description = self._bulkArrays[name]
+            self.add(pr.LocalVariable(  name        = name,
+                                        description = description,
+                                        mode        = mode,
+                                        value       = numpy.zeros(number, dtype=numpy.uint32),
+                                        localGet    = lambda dev, var: dev.readArray(var.name),
+                                        localSet    = lambda dev, var, value: dev.writeArray(var.name, value)))
+
+"""
+
+# Remove one indentation level from the lines of a block of code
+def dedent(code):
+    return re.sub(r'(?m)^    ', '', code)
+
+# Loop building the children of all the groups, used on split mode
+groupsLoop = """\
+        for group in self._groups:
+            importlib.import_module("." + group, __name__).build(self)
+
+"""
+
+# Methods building the lazy children, used on split mode with lazy mode
+lazyMethods = """\
+    # Build the children of a group
+    def _loadGroup(self, group):
+        if group not in self._lazyLoaded:
+            self._lazyLoaded.add(group)
+            importlib.import_module("." + group, __name__).build(self)
+
+    # Build all the children which were not accessed yet. Call it before
+    # walking the whole tree
+    def loadAll(self):
+        for group in sorted(set(self._lazyChildren.values())):
+            self._loadGroup(group)
+
+    # Build the children on first access
+    def __getattr__(self, name):
+        group = self._lazyChildren.get(name)
+        if group is not None and "_lazyLoaded" in self.__dict__ and group not in self._lazyLoaded:
+            self._loadGroup(group)
+            return getattr(self, name)
+
+        try:
+            getattr_ = super(%(name)s, self).__getattr__
+        except AttributeError:
+            raise AttributeError(name)
+        return getattr_(name)
+
+"""
+
+# Loop adding the variables defined on the table, used on compact mode. The
+# methods adding them are looked up once, instead of once for each row
+compactVariablesLoop = """\
+        addVariable  = self.addVariable
+        addVariables = self.addVariables
+        for vName, vDescription, vOffset, vBitSize, vBitOffset, vBase, vMode, vEnum, vNumber, vStride in self._variables:
+            if vNumber is None:
+                addVariable(name=vName, description=vDescription, offset=vOffset, bitSize=vBitSize,
+                            bitOffset=vBitOffset, base=vBase, mode=vMode, enum=vEnum)
+            else:
+                addVariables(name=vName, description=vDescription, offset=vOffset, bitSize=vBitSize,
+                             bitOffset=vBitOffset, base=vBase, mode=vMode, enum=vEnum,
+                             number=vNumber, stride=vStride)
+
+"""
+
+# Get the key identifying a module definition. All the devices merged from the
+# same anchor share the same "children" object, so it identifies the module
+# together with the other properties of the merging mapping, which can
+# override the ones of the anchor. The placement of the device ("at") and its
+# description, given to each device instance, are not part of the module.
+def moduleKey(node):
+    if node and node.get("children"):
+        return (id(node["children"]), repr(sorted((k, v) for k, v in node.items() if k not in ("at", "description", "children"))))
+    return id(node)
+
+# Class to process a device child (MMIODev) of a module on the YAML file
+class YamlDevice:
+    # Indentation levels
+    #-------------------------------------------------->|<- L5
+    #------------------------------------------->|<-L4  |
+    #------------------------------>|<-L3        |      |
+    #---------------------->|<-L2   |            |      |
+    #-->|<-L1               |       |            |      |
+    #   |self.add(module(   |       |            |      |
+    #   |                   |       |name        |=     |'name',
+    #   |                   |       |description |=     |'description',
+    #   |                   |       |offset      |=     | 0x00,
+    #   |                   |))     |            |      |
+    #
+    layout = YamlChild.layout
+
+    def __init__(self, children, var, date, devices, options):
+        node = children[var]
+        at   = node.get("at") or {}
+
+        # This is the device name
+        self.name = var
 
-    # Method to get if this child is a variable
-    def isVariable(self):
-        return self.isVariable
+        # These are the node we want to have on the python instance
+        self.description = node.get("description", "")
+        self.offset      = at.get("offset", 0)
+
+        # Check if this is an array of devices. 'stride' is optional on YAML,
+        # and it defaults to the device size
+        self.isArray = "nelms" in at
+        if self.isArray:
+            self.number = at["nelms"]
+            self.stride = at.get("stride", node.get("size"))
+            if self.stride is None:
+                raise ValueError("Device \"%s\" is an array, but it has no \"stride\" nor \"size\"" % var)
+
+        # Get the module this device instantiates. Each module is processed
+        # only once, no matter how many devices instantiate it
+        self.module = devices.get(moduleKey(node))
+        if not self.module:
+            className = re.sub(r'\W', '_', str(node.get("name", var)))
+            names = set(ym.name for ym in devices.values())
+            if className in names:
+                i = 1
+                while "%s_%d" % (className, i) in names:
+                    i += 1
+                className = "%s_%d" % (className, i)
+
+            self.module = YamlModule({className: node}, className, "", "", date, devices, options)
+            self.module.isTop = False
+
+    # Method to get the equivalent python instance
+    def getPyClass(self, buf):
+        L = self.layout
+
+        if self.isArray:
+            buf.append("%sfor i in range(%d):\n" % (L.indent[1], self.number))
+            indent = "    "
+            name   = "\"%s[%%d]\" %% i" % self.name
+            offset = "0x%02X + i * 0x%02X" % (self.offset, self.stride)
+        else:
+            indent = ""
+            name   = "\"%s\"" % self.name
+            offset = "0x%02X" % self.offset
+
+        buf.append("%s%sself.add(%s(\n" % (L.indent[1], indent, self.module.name))
+        buf.append("%s%s= %s,\n" % (indent, L.field("name", 3, 4), name))
+        buf.append("%s%s= \"%s\",\n" % (indent, L.field("description", 3, 4), self.description))
+        buf.append("%s%s=  %s,\n" % (indent, L.field("offset", 3, 4), offset))
+        buf.append("%s%s))\n\n" % (L.indent[2], indent))
+
+# Maximum size of the code kept on memory by each section of a module, on
+# streaming mode. Bigger sections are moved to a temporary file.
+spoolSize = 1 << 20
+
+# Output buffer writing the code to a file as it is generated, instead of
+# keeping it on memory, used on streaming mode
+class FileBuffer:
+    def __init__(self, f):
+        self.append = f.write
+
+# Output buffer keeping a section of a module until the whole module has been
+# read, used on streaming mode. Big sections are moved to a temporary file.
+class SpoolBuffer:
+    def __init__(self):
+        self.f      = tempfile.SpooledTemporaryFile(max_size=spoolSize)
+        self.append = self.f.write
+
+    # Copy the content of the buffer to another buffer, and close it
+    def copyTo(self, buf):
+        self.f.seek(0)
+        for chunk in iter(lambda: self.f.read(1 << 16), ""):
+            buf.append(chunk)
+        self.f.close()
+
+# Class to process a module on the YAML file on streaming mode. Each child is
+# converted as soon as it is read and the code of each section is kept on a
+# spool buffer, so the children are not kept on memory. The class is written
+# when the whole module has been read, as the properties needed on its
+# header can be found after the children.
+class StreamModule(YamlModule):
+    def __init__(self, node, module, title, description, date, devices, options):
+        # A module on streaming mode always has its children node, even if it
+        # hasn't been read yet
+        node = collections.OrderedDict(node)
+        node["children"] = None
+        YamlModule.__init__(self, {module: node}, module, title, description, date, devices, options)
+
+        # Module title and description given, to get the default ones again if
+        # the module properties change
+        self.givenTitle       = title
+        self.givenDescription = description
+
+        self.hasChildren = True
+        self.yCV = []
+        self.yCC = []
+        self.yCD = []
+        self.yCA = []
+
+        # Nodes of the module and its devices. Modules are identified by their
+        # node, so they must be kept while the file is converted
+        self.nodes = [node]
+
+        # Code of each section
+        self.classes   = SpoolBuffer()
+        self.devices   = SpoolBuffer()
+        self.variables  = SpoolBuffer()
+        self.commands   = SpoolBuffer()
+        self.bulkArrays = SpoolBuffer()
+
+        # Classes of the modules of the devices already written
+        self.emitted = set()
+
+    # Method to get the module properties from its node, when they change
+    # after the children have been read
+    def updateProperties(self, node):
+        self.title       = self.givenTitle
+        self.description = self.givenDescription
+        self.setProperties(node)
+
+    # Method to process a child of the module, and write its code on the
+    # buffer of its section
+    def addChild(self, children, var, devices):
+        child = YamlModule.addChild(self, children, var, devices)
+
+        if isinstance(child, YamlDevice):
+            self.nodes.append(children[var])
+            if child.module not in self.emitted and not child.module.isTop:
+                child.module.getPyClass(self.classes, self.emitted)
+            child.getPyClass(self.devices)
+            self.yCD.pop()
+        elif child.isVariable:
+            if self.yCA:
+                child.getPyBulkArrayRow(self.bulkArrays)
+                self.yCA.pop()
+            elif self.options.get("compact"):
+                child.getPyVariableRow(self.variables)
+                self.yCV.pop()
+            else:
+                child.getPyClass(self.variables)
+                self.yCV.pop()
+        elif child.isCommand:
+            child.getPyClass(self.commands)
+            self.yCC.pop()
+
+        return child
+
+    def getPyDeviceClasses(self, buf, emitted):
+        self.classes.copyTo(buf)
+
+    def getPyDevices(self, buf):
+        self.devices.copyTo(buf)
+
+    def getPyVariableRows(self, buf, variables):
+        self.variables.copyTo(buf)
+
+    def getPyVariables(self, buf):
+        if self.options.get("compact"):
+            YamlModule.getPyVariables(self, buf)
+        else:
+            self.variables.copyTo(buf)
+
+    def getPyCommands(self, buf):
+        self.commands.copyTo(buf)
+
+    def getPyBulkArrayRows(self, buf):
+        self.bulkArrays.copyTo(buf)
+
+# Class to convert a YAML file on streaming mode. The file is read as a
+# stream of events, and only one child node at a time is built, so the
+# memory needed doesn't depend on the size of the file. Included files
+# and aliases are not supported, as they need the whole document.
+class YamlStream:
+    # Options not supported on streaming mode, as they need all the children
+    # of a module
+    unsupportedOptions = ("split", "coalesce", "batchWrites", "dedup", "addressIndex")
+
+    def __init__(self, yamlFile, title, description, date, options):
+        for option in self.unsupportedOptions:
+            if options.get(option):
+                raise ValueError("Option \"%s\" is not supported on streaming mode" % option)
+
+        self.yamlFile    = yamlFile
+        self.title       = title
+        self.description = description
+        self.date        = date
+        self.options     = options
+
+        # Modules converted, without their children, including the modules
+        # instantiated as devices
+        self.modules = []
+
+        # Nodes of the modules without children. Modules are identified by their
+        # node, so they must be kept while the file is converted
+        self.nodes = []
+
+    # Method to convert the YAML file, writing the python code on a file
+    def write(self, f):
+        buf     = FileBuffer(f)
+        emitted = set()
+        devices = collections.OrderedDict()
+
+        self.checkIncludes()
+
+        with open(self.yamlFile, "rb") as stream:
+            loader = OrderedLoader(stream)
+            try:
+                self.expect(loader, yaml.StreamStartEvent)
+                self.expect(loader, yaml.DocumentStartEvent)
+                self.expect(loader, yaml.MappingStartEvent)
+
+                while not loader.check_event(yaml.MappingEndEvent):
+                    module = self.getObject(loader)
+                    if loader.check_event(yaml.MappingStartEvent):
+                        ym = self.getModule(loader, module, devices)
+                    else:
+                        node = self.getObject(loader)
+                        self.nodes.append(node)
+                        ym = YamlModule({module: node}, module, self.title, self.description, self.date, devices, self.options)
+                    ym.getPyClass(buf, emitted)
+            finally:
+                loader.dispose()
+
+        self.modules = devices.values()
+
+    # Method to check that the YAML file doesn't include other files. The
+    # include directives are YAML comments, so the parser would skip them
+    # and the included definitions would be silently dropped. The file is
+    # read line by line, so it is not kept in memory
+    def checkIncludes(self):
+        with open(self.yamlFile, "rb") as stream:
+            for number, line in enumerate(stream, 1):
+                inc = includeRe.match(line)
+                if inc:
+                    raise ValueError("File \"%s\" includes \"%s\" on line %d, includes are not supported on streaming mode" %
+                                     (self.yamlFile, inc.group(1), number))
+
+    # Method to read a module, converting its children as they are read
+    def getModule(self, loader, module, devices):
+        self.expect(loader, yaml.MappingStartEvent)
+
+        node = collections.OrderedDict()
+        ym   = None
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = self.getObject(loader)
+            if key == "children" and loader.check_event(yaml.MappingStartEvent):
+                ym = StreamModule(node, module, self.title, self.description, self.date, devices, self.options)
+                self.expect(loader, yaml.MappingStartEvent)
+                while not loader.check_event(yaml.MappingEndEvent):
+                    var = self.getObject(loader)
+                    ym.addChild({var: self.getObject(loader)}, var, devices)
+                self.expect(loader, yaml.MappingEndEvent)
+            else:
+                node[key] = self.getObject(loader)
+                if ym:
+                    ym.updateProperties(node)
+
+        self.expect(loader, yaml.MappingEndEvent)
+
+        if ym is None:
+            self.nodes.append(node)
+            ym = YamlModule({module: node}, module, self.title, self.description, self.date, devices, self.options)
+
+        return ym
+
+    # Method to read the next node, and get its python object
+    def getObject(self, loader):
+        return loader.construct_document(self.getNode(loader))
+
+    # Method to build the next node from the events
+    def getNode(self, loader):
+        return composeNode(loader)
+
+    # Method to read the next event, which must be of the expected type
+    def expect(self, loader, eventClass):
+        event = loader.get_event()
+        if not isinstance(event, eventClass):
+            raise yaml.YAMLError("Expected %s, found %s\n%s" % (eventClass.__name__, type(event).__name__, event.start_mark))
+        return event
+
+    # Method to get the conversion report lines of all the modules
+    def getReport(self):
+        report = []
+        for ym in self.modules:
+            ym.getReport(report)
+        return report
+
+    # Method to get the number of modules, variables, commands, devices, enums
+    # and arrays of the file
+    def getStats(self):
+        return getModuleStats(self.modules)
+
+    # Method to get the shared enum tables used by the modules, by name
+    def getEnums(self):
+        return getModuleEnums(self.modules)
+
+# Bounded cache keeping the most recently used entries. When it is full,
+# the least recently used entry is dropped.
+class LruCache:
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.entries = collections.OrderedDict()
+        self.hits    = 0
+        self.misses  = 0
+
+    # Method to get an entry, or None if it is not on the cache
+    def get(self, key):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        # Add it again, as the most recently used
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    # Method to add an entry, dropping the least recently used ones
+    # if the cache is full
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        self.resize(self.maxSize)
+
+    # Method to change the maximum number of entries, dropping the least
+    # recently used ones that don't fit anymore
+    def resize(self, maxSize):
+        self.maxSize = maxSize
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    # Method to drop all the entries
+    def clear(self):
+        self.entries.clear()
+        self.hits   = 0
+        self.misses = 0
+
+# Models built by the in-process API, pickled so they can't be modified, and
+# their generated code, by hash of the YAML source and the conversion arguments
+modelCache = LruCache(32)
+
+# Get the YAML source of a text or stream, and the files it includes, searched
+# on the include directory. Return the text and the list of included files,
+# directly or not, in include order.
+def textSource(source, includeDir):
+    if hasattr(source, "read"):
+        source = source.read()
+    if isinstance(source, unicode):
+        source = source.encode("utf-8")
+
+    deps    = []
+    visited = set()
+    for inc in includeRe.findall(source):
+        incFile = os.path.join(includeDir, inc)
+        if not os.path.isfile(incFile):
+            raise IOError("File \"%s\" included from the YAML text doesn't exist" % inc)
+        yamlDependencies(incFile, deps, visited)
+
+    return source, deps
+
+# Get the cache entry of a YAML text or stream: its pickled model and, once
+# rendered, its code. The model is built only if the same source wasn't
+# already converted with the same arguments; then it is returned too, else
+# None. The included files are identified by their path, modification time
+# and size, so they are only read again when they change.
+def getCacheEntry(source, title, description, date, options, includeDir):
+    options = dict(options or {})
+    if options.get("stream"):
+        raise ValueError("Streaming mode is not supported by the in-process API")
+    if options.get("dedup") and options.get("split"):
+        raise ValueError("Option \"dedup\" is not supported on split mode")
+    if date is None:
+        date = today()
+
+    text, deps = textSource(source, includeDir)
+
+    # The source is hashed by parts: the included files and the text itself
+    key = hashlib.sha1("%d\n%r\n" % (cacheVersion, (title, description, date, sorted(options.items()))))
+    for dep in deps:
+        key.update("%s %r\n" % (dep, sourceCache[dep][0]))
+    key.update(text)
+    key = key.hexdigest()
+
+    entry = modelCache.get(key)
+    if entry is not None:
+        return entry, None
+
+    doc = parseYaml(text, deps)
+    yD  = YamlDoc(None, title, description, date, options=options, doc=doc, deps=deps)
+
+    # Check the address maps before the model is pickled, so the bit ranges
+    # are freed and each copy gets the result of the check
+    yD.getReport()
+
+    entry = [cPickle.dumps(yD, cPickle.HIGHEST_PROTOCOL), None, options]
+    modelCache.put(key, entry)
+
+    return entry, yD
+
+# Get the model of a YAML text or stream, without writing any file: the
+# YamlDoc of the modules defined on it. Included files are searched on the
+# include directory. Each call gets its own copy of the model, unpickled
+# from the cache if the same source was converted with the same arguments.
+def yamlToModel(source, title="", description="", date=None, options=None, includeDir="."):
+    entry, yD = getCacheEntry(source, title, description, date, options, includeDir)
+    if yD is None:
+        yD = cPickle.loads(entry[0])
+    return yD
+
+# Get the python code equivalent to a YAML text or stream, without writing
+# any file. On split mode, return the content of each file of the package,
+# by file name. The classes shared on dedup mode and the enum tables shared
+# on shared enums mode are got from the model (getBases and getEnums).
+def yamlToPython(source, title="", description="", date=None, options=None, includeDir="."):
+    entry, yD = getCacheEntry(source, title, description, date, options, includeDir)
+    snapshot, code, options = entry
+
+    if code is None:
+        if yD is None:
+            yD = cPickle.loads(snapshot)
+        if options.get("split"):
+            code = yD.renderPackage()
+        else:
+            code = yD.render()
+        entry[1] = code
+
+    if options.get("split"):
+        return collections.OrderedDict(code)
+    return code
+
+# Convert a YAML file into its equivalent python file.
+# Return the conversion report lines. If a statistics dictionary is given,
+# the time and peak memory of each phase, and the counts of the file, are
+# added to it. If an enums dictionary is given, the shared enum tables used
+# by the file are added to it. If a deferred list is given, on dedup mode the
+# file is not written if it has modules which could derive from a shared
+# class: its code is kept on a temporary file, to be written once the classes
+# shared by the modules converted together are known (writeDeferred), and
+# the temporary file and the number of modules with each structure are
+# added to the list.
+def convertModule(yamlFile, pythonFile, options, date, cacheDir=None, stats=None, enums=None, deferred=None):
+    phases = collections.OrderedDict()
+
+    # On split mode, the output is a package: a directory named as the
+    # module, instead of the python file
+    packageDir = os.path.splitext(pythonFile)[0]
+
+    # On streaming mode, the YAML file is read, processed and written as
+    # python code at the same time
+    if options.get("stream"):
+        start = phaseStart()
+        yD    = YamlStream(yamlFile, options["title"], options["description"], date, options)
+        streamFileIfChanged(pythonFile, yD.write)
+        removePackage(packageDir)
+        recordPhase(phases, "stream", start)
+
+        if stats is not None:
+            stats["phases"]    = phases
+            stats["peakRssKB"] = filePeakRss(phases)
+            stats["counts"]    = yD.getStats()
+
+        if enums is not None:
+            enums.update(yD.getEnums())
+
+        return yD.getReport()
+
+    # Read the YAML file
+    start = phaseStart()
+    doc   = loadYaml(yamlFile, cacheDir)
+    start = recordPhase(phases, "load", start)
+
+    # Process the YAML definitions
+    yD    = YamlDoc(yamlFile, options["title"], options["description"], date, cacheDir, options, doc)
+    start = recordPhase(phases, "build", start)
+
+    # The YAML definitions are not needed anymore, free them before the code
+    # is generated
+    del doc
+
+    # Get the equivalent Python class, and write the output python file.
+    # Leave it untouched if its content didn't change, so its timestamp
+    # doesn't trigger rebuilds
+    shared = None
+    if options.get("split"):
+        files = yD.renderPackage()
+        start = recordPhase(phases, "emit", start)
+
+        writePackage(packageDir, files)
+        removeGenerated(os.path.dirname(pythonFile), only=[os.path.basename(pythonFile)])
+    else:
+        parts = yD.renderParts()
+        start = recordPhase(phases, "emit", start)
+
+        # On dedup mode, the modules derive from the classes shared by at
+        # least two modules. Unless the file is deferred, only the modules of
+        # this file are counted, and the shared classes are written with it
+        structures = yD.getStructures()
+        if structures and deferred is not None:
+            shared = set()
+            deferred.append((saveDeferred(parts, yD.getBases(set(structures))), structures))
+        else:
+            shared = yD.getShared()
+            writeFileIfChanged(pythonFile, joinParts(parts, shared))
+            for baseName, content in yD.getBases(shared).items():
+                writeFileIfChanged(os.path.join(os.path.dirname(pythonFile), "_%s.py" % baseName), content)
+        removePackage(packageDir)
+
+    # Write the address index, or remove the one left by a previous run
+    if options.get("addressIndex"):
+        writeFileIfChanged(indexFile(pythonFile), yD.getIndex())
+    elif os.path.isfile(indexFile(pythonFile)):
+        os.remove(indexFile(pythonFile))
+
+    recordPhase(phases, "write", start)
+
+    if stats is not None:
+        stats["phases"]    = phases
+        stats["peakRssKB"] = filePeakRss(phases)
+        stats["counts"]    = yD.getStats()
+
+    if enums is not None:
+        enums.update(yD.getEnums())
+
+    return yD.getReport(shared)
+
+# Keep the code of a file on dedup mode until the shared classes are known:
+# its parts and the files of the classes it could share are pickled on a
+# temporary file. Return the temporary file name
+def saveDeferred(parts, bases):
+    fd, deferredFile = tempfile.mkstemp(prefix="yaml2py-", suffix=".pickle")
+    with os.fdopen(fd, "wb") as f:
+        cPickle.dump((parts, bases), f, cPickle.HIGHEST_PROTOCOL)
+    return deferredFile
+
+# Write the code of a file kept on dedup mode, given the names of the shared
+# classes, and the files of the shared classes it uses. The temporary file is
+# removed. Return the names of the shared classes used
+def writeDeferred(pythonFile, deferredFile, shared):
+    try:
+        with open(deferredFile, "rb") as f:
+            parts, bases = cPickle.load(f)
+    finally:
+        os.remove(deferredFile)
+
+    writeFileIfChanged(pythonFile, joinParts(parts, shared))
+
+    used = sorted(name for name in bases if name in shared)
+    for baseName in used:
+        writeFileIfChanged(os.path.join(os.path.dirname(pythonFile), "_%s.py" % baseName), bases[baseName])
+    return used
+
+# Get the number of modules with each structure, by the name of the class
+# they would share on dedup mode, adding the ones of several files
+def countStructures(fileStructures):
+    counts = {}
+    for structures in fileStructures:
+        for name, count in structures.items():
+            counts[name] = counts.get(name, 0) + count
+    return counts
+
+# Name of the file listing the files of a package written on split mode. Only
+# the packages with it are changed or removed by the generator, so a package
+# written by hand named as a module is never touched
+packageMarker = ".yaml2py.package"
+
+# Get the files of a package written on split mode, or None if the directory
+# doesn't have the package marker
+def packageFiles(packageDir):
+    try:
+        with open(os.path.join(packageDir, packageMarker), "r") as f:
+            return f.read().split()
+    except IOError:
+        return None
+
+# Write the files of a package on split mode, and remove the ones left by a
+# previous run. An existing directory is only used if it is empty or it was
+# written by the generator
+def writePackage(packageDir, files):
+    old = []
+    if os.path.isdir(packageDir):
+        old = packageFiles(packageDir)
+        if old is None:
+            if os.listdir(packageDir):
+                raise IOError("Directory \"%s\" exists and it was not written by yaml2py" % packageDir)
+            old = []
+    else:
+        os.mkdir(packageDir)
+
+    for fileName in files:
+        writeFileIfChanged(os.path.join(packageDir, fileName), files[fileName])
+    writeFileIfChanged(os.path.join(packageDir, packageMarker), "".join("%s\n" % fileName for fileName in files))
+
+    removeGenerated(packageDir, old, keep=files)
+
+# Remove the package left by a previous run on split mode, as it would be
+# imported instead of the python file. Only the files the generator wrote are
+# removed, and the directory if nothing else is left on it
+def removePackage(packageDir):
+    files = packageFiles(packageDir)
+    if files is None:
+        return
+
+    removeGenerated(packageDir, files)
+    os.remove(os.path.join(packageDir, packageMarker))
+    try:
+        os.rmdir(packageDir)
+    except OSError:
+        pass
+
+# Get the start of a conversion phase: the time, the resident memory, and
+# whether the peak resident memory could be reset, so it is the one of the phase
+def phaseStart():
+    return time.time(), currentRss(), resetPeakRss()
+
+# Record the wall time of a conversion phase, started at 'start', the change
+# of the resident memory of the process during it, its peak memory (if the
+# peak could be reset at its start), and the peak memory of the process so far
+# (it is never lowered, so it is the peak of this phase or of any earlier
+# one). Return the start of the next phase
+def recordPhase(phases, phase, start):
+    peak  = peakRss() if start[2] else None
+    end   = phaseStart()
+    delta = end[1] - start[1] if end[1] is not None and start[1] is not None else None
+    phases[phase] = collections.OrderedDict([("time", round(end[0] - start[0], 6)),
+                                             ("rssDeltaKB", delta),
+                                             ("peakRssKB", peak),
+                                             ("processMaxRssKB", maxRss())])
+    return end
+
+# Get the peak memory of the conversion of a file: the highest peak of its
+# phases, or None if the peak of any of them is not available
+def filePeakRss(phases):
+    peaks = [p["peakRssKB"] for p in phases.values()]
+    if None in peaks:
+        return None
+    return max(peaks)
+
+# Get the current resident memory of the process in kB, or None if it is not
+# available (it is read from /proc, on Linux)
+def currentRss():
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+    return pages * (os.sysconf("SC_PAGE_SIZE") // 1024)
+
+# Get the peak resident memory of the process since it was last reset, in kB,
+# or None if it is not available (it is read from /proc, on Linux)
+def peakRss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+# Peak resident memory of each process before its peak was last reset, in kB,
+# by process id (the worker processes inherit it). Resetting the peak also
+# resets the one reported by getrusage on Linux, so it is kept here
+rssPeaks = {}
+
+# Reset the peak resident memory of the process to its current resident
+# memory. Return whether it could be reset (it needs Linux 4.0 or later)
+def resetPeakRss():
+    peak = peakRss()
+    if peak is None:
+        return False
+    pid = os.getpid()
+    rssPeaks[pid] = max(rssPeaks.get(pid, 0), peak)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        return False
+    return True
+
+# Get the peak resident memory of the process (or of its finished children)
+# in kB, or None if it is not available
+def maxRss(who=None):
+    if resource is None:
+        return None
+    if who is None:
+        who = resource.RUSAGE_SELF
+    rss = resource.getrusage(who).ru_maxrss
+    # It is reported in bytes on macOS, and in kB on Linux
+    if sys.platform == "darwin":
+        rss //= 1024
+    if who == resource.RUSAGE_SELF:
+        rss = max(rss, rssPeaks.get(os.getpid(), 0))
+    return rss
+
+# Write the conversion statistics as JSON
+def writeStats(statsFile, stats):
+    writeFileAtomic(statsFile, json.dumps(stats, indent=1) + "\n")
+
+# Get the address index file written next to a python file
+def indexFile(pythonFile):
+    return os.path.splitext(pythonFile)[0] + ".idx"
+
+# Get the output python file, or the package "__init__.py" on split mode
+def outputFile(pythonDir, moduleName, options):
+    if options.get("split"):
+        return os.path.join(pythonDir, moduleName, "__init__.py")
+    return os.path.join(pythonDir, moduleName + ".py")
+
+# Remove generated python files (and their compiled files) from a directory.
+# Only the files listed are removed, and the files to keep are left.
+def removeGenerated(directory, only, keep=()):
+    for fileName in os.listdir(directory):
+        source = fileName[:-1] if fileName.endswith(".pyc") else fileName
+        if not source.endswith(".py") or source in keep or source not in only:
+            continue
+        os.remove(os.path.join(directory, fileName))
+
+# Write a file only if the new content is different from the current one
+def writeFileIfChanged(fileName, content):
+    if os.path.isfile(fileName):
+        with open(fileName, "r") as f:
+            if f.read() == content:
+                return False
+
+    writeFileAtomic(fileName, content)
+
+    return True
+
+# Write a file atomically: write a temporary file on the same directory
+# and then rename it, so readers never see a partial file
+def writeFileAtomic(fileName, content):
+    fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fileName)), prefix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        # mkstemp creates the file only readable by its owner,
+        # use the same permissions a normal open() would use
+        os.chmod(tmpName, 0666 & ~umask)
+        os.rename(tmpName, fileName)
+    except:
+        os.remove(tmpName)
+        raise
+
+# Write a file atomically, like writeFileAtomic, with the content written on
+# the open file by a function, so it doesn't need to be kept on memory. Leave
+# the file untouched if its content didn't change
+def streamFileIfChanged(fileName, write):
+    fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fileName)), prefix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            write(f)
+        if os.path.isfile(fileName) and filecmp.cmp(tmpName, fileName, shallow=False):
+            os.remove(tmpName)
+            return False
+        os.chmod(tmpName, 0666 & ~umask)
+        os.rename(tmpName, fileName)
+    except:
+        os.remove(tmpName)
+        raise
+
+    return True
+
+# Get the SHA1 hash of a file content
+def fileHash(fileName):
+    with open(fileName, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+# Get the generator version. A hash of this script is included so any change
+# on the generator invalidates the manifest entries made by the old one
+def generatorVersion():
+    sourceFile = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+    return "%s-%s" % (__version__, fileHash(sourceFile)[:12])
+
+# Read the manifest from the python directory. Return an empty one if it
+# doesn't exist or it can not be read
+def readManifest(pythonDir):
+    try:
+        with open(os.path.join(pythonDir, manifestName), "r") as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+    if not isinstance(manifest, dict):
+        return {}
+
+    return manifest
+
+# Write the manifest into the python directory
+def writeManifest(pythonDir, manifest):
+    writeFileAtomic(os.path.join(pythonDir, manifestName), json.dumps(manifest, indent=1, sort_keys=True) + "\n")
+
+# Batch mode worker. It runs on the pool processes, so it must not raise:
+# the error is returned to the parent process instead, so the rest of the
+# batch keeps going when one file fails.
+def convertWorker(task):
+    yamlFile, pythonFile, options, date, cacheDir, withStats = task
+    stats = {} if withStats else None
+    enums = {}
+    deferred = []
+    try:
+        report = convertModule(yamlFile, pythonFile, options, date, cacheDir, stats, enums, deferred)
+    except Exception as e:
+        for deferredFile, structures in deferred:
+            os.remove(deferredFile)
+        return (yamlFile, pythonFile, "%s: %s" % (type(e).__name__, e), [], stats, {}, [])
+    return (yamlFile, pythonFile, None, report, stats, enums, deferred)
+
+# Get the list of YAML files to convert in batch mode. The input can be
+# a directory (all the .yaml files of its tree are used, skipping the hidden
+# directories) or a glob pattern
+def findModules(batch):
+    if not os.path.isdir(batch):
+        return sorted(glob.glob(batch))
+
+    yamlFiles = []
+    for directory, subDirs, fileNames in os.walk(batch):
+        subDirs[:] = [d for d in subDirs if not d.startswith(".")]
+        yamlFiles.extend(os.path.join(directory, f) for f in fileNames if f.endswith(".yaml"))
+    return sorted(yamlFiles)
+
+# Get the YAML files of a list which would be converted to the same python
+# module, as the modules of a tree are all written on the python directory.
+# Return a list of (module name, YAML files) pairs
+def duplicateModules(yamlFiles):
+    modules = collections.OrderedDict()
+    for yamlFile in yamlFiles:
+        modules.setdefault(os.path.splitext(os.path.basename(yamlFile))[0], []).append(yamlFile)
+    return [(name, files) for name, files in modules.items() if len(files) > 1]
+
+# Convert a list of YAML files using a pool of worker processes.
+# On incremental mode, the files which didn't change since the last run
+# are skipped, and the manifest is updated with the converted ones.
+# On dedup mode, the files with modules which could derive from a shared
+# class are written once all the files are converted, when the classes
+# shared by at least two modules are known.
+# If a statistics file is given, the statistics of the conversion are
+# written on it.
+def convertModules(yamlFiles, pythonDir, options, date, jobs, incremental, cacheDir=None, statsFile=""):
+    startTime = time.time()
+    fileStats = collections.OrderedDict()
+
+    if incremental:
+        manifest = readManifest(pythonDir)
+        version  = generatorVersion()
+
+    tasks   = []
+    entries = {}
+    skipped = 0
+    skippedTasks = {}
+    for yamlFile in yamlFiles:
+        moduleName = os.path.splitext(os.path.basename(yamlFile))[0]
+        pythonFile = os.path.join(pythonDir, moduleName + ".py")
+        taskDate   = date
+
+        if incremental:
+            entry = {
+                "input"     : sourceHash(yamlFile),
+                "generator" : version,
+                "options"   : options,
+            }
+            oldEntry = manifest.get(moduleName)
+            if oldEntry:
+                # Keep the original creation date, so a regenerated
+                # file only changes if its content does
+                taskDate = oldEntry.get("date", date)
+
+                if (os.path.isfile(outputFile(pythonDir, moduleName, options)) and
+                    (not options.get("addressIndex") or os.path.isfile(indexFile(pythonFile))) and
+                    all(oldEntry.get(k) == v for k, v in entry.items())):
+                    skipped += 1
+                    fileStats[yamlFile] = collections.OrderedDict([("yamlFile", yamlFile), ("status", "skipped")])
+                    entry["date"] = taskDate
+                    skippedTasks[yamlFile] = (moduleName, entry, (yamlFile, pythonFile, options, taskDate, cacheDir, bool(statsFile)))
+                    continue
+
+            entry["date"] = taskDate
+            entries[yamlFile] = (moduleName, entry)
+
+        tasks.append((yamlFile, pythonFile, options, taskDate, cacheDir, bool(statsFile)))
+        fileStats[yamlFile] = None
+
+    # Do not pay for the pool when there is only one job to run
+    jobs = min(jobs, len(tasks))
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+    else:
+        pool = None
+
+    failed    = 0
+    enums     = {}
+    deferred  = []
+    converted = set()
+    pending   = tasks
+    while pending:
+        if pool:
+            results = pool.imap_unordered(convertWorker, pending)
+        else:
+            results = (convertWorker(task) for task in pending)
+
+        for yamlFile, pythonFile, error, report, stats, fileEnums, fileDeferred in results:
+            enums.update(fileEnums)
+
+            if statsFile:
+                entry = collections.OrderedDict([("yamlFile", yamlFile), ("pythonFile", pythonFile), ("status", "failed" if error else "converted")])
+                if error:
+                    entry["error"] = error
+                entry.update(stats)
+                fileStats[yamlFile] = entry
+
+            if error:
+                failed += 1
+                print "Module %s failed: %s" % (yamlFile, error)
+            else:
+                moduleName = os.path.splitext(os.path.basename(yamlFile))[0]
+                converted.add(moduleName)
+                for deferredFile, structures in fileDeferred:
+                    deferred.append((moduleName, pythonFile, deferredFile, structures))
+                if incremental:
+                    moduleName, entry = entries[yamlFile]
+                    if options.get("sharedEnums"):
+                        entry["enums"] = sorted(fileEnums)
+                    if options.get("dedup"):
+                        entry["structures"] = countStructures(structures for deferredFile, structures in fileDeferred)
+                        entry["bases"]      = []
+                    manifest[moduleName] = entry
+                if options.get("split"):
+                    pythonFile = os.path.dirname(outputFile(pythonDir, moduleName, options))
+                print "Module %s converted from %s to %s" % (moduleName, yamlFile, pythonFile)
+                for line in report:
+                    print "    %s" % line
+
+        # On dedup mode, the modules derive from the classes shared by at
+        # least two modules: the ones converted now and, on incremental mode,
+        # the ones not converted, whose structures are on the manifest. The
+        # skipped modules whose shared classes changed are converted again
+        pending = []
+        if options.get("dedup"):
+            fileStructures = [structures for moduleName, pythonFile, deferredFile, structures in deferred]
+            if incremental:
+                fileStructures += [entry.get("structures", {}) for moduleName, entry in manifest.items()
+                                   if moduleName not in converted and os.path.isfile(os.path.join(pythonDir, moduleName + ".py"))]
+            counts = countStructures(fileStructures)
+            shared = sharedBases(counts)
+
+            for yamlFile, (moduleName, entry, task) in skippedTasks.items():
+                oldEntry = manifest[moduleName]
+                if sorted(set(oldEntry.get("structures", {})) & shared) != oldEntry.get("bases", []):
+                    del skippedTasks[yamlFile]
+                    entries[yamlFile]   = (moduleName, entry)
+                    fileStats[yamlFile] = None
+                    skipped -= 1
+                    tasks.append(task)
+                    pending.append(task)
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    # On dedup mode, write the files kept until the shared classes were known
+    used = set()
+    for moduleName, pythonFile, deferredFile, structures in deferred:
+        bases = writeDeferred(pythonFile, deferredFile, shared)
+        if incremental:
+            manifest[moduleName]["bases"] = bases
+        used.update(bases)
+    for baseName in sorted(used):
+        print "Class %s shared by %d modules" % (baseName, counts[baseName])
+
+    if incremental and tasks:
+        writeManifest(pythonDir, manifest)
+
+    # On dedup mode, remove the shared classes no module uses: on incremental
+    # mode the manifest has the classes used by each module, otherwise the
+    # python files are read. They are removed before the shared enum tables
+    # are written, as they use them
+    if options.get("dedup") and tasks:
+        if incremental:
+            keep = set("_%s.py" % name for entry in manifest.values() for name in entry.get("bases", []))
+        else:
+            keep = usedBaseFiles(pythonDir)
+        removeGenerated(pythonDir, only=[f for f in os.listdir(pythonDir) if baseFileRe.match(f) and f not in keep])
+
+    # On shared enums mode, write the module with the enum tables used by all
+    # the modules. The tables of the modules not converted now are kept, and
+    # the ones no module uses are removed: on incremental mode the manifest
+    # has the tables used by each module, otherwise the python files are read
+    if options.get("sharedEnums") and tasks:
+        if incremental:
+            keep = set(name for entry in manifest.values() for name in entry.get("enums", []))
+        else:
+            keep = usedSharedEnums(pythonDir)
+        writeSharedEnums(pythonDir, enums, keep | set(enums))
+
+    if len(yamlFiles) > 1:
+        print ""
+        print "%d modules converted, %d up to date, %d failed" % (len(tasks) - failed, skipped, failed)
+    elif skipped:
+        print "Module %s is up to date" % os.path.splitext(os.path.basename(yamlFiles[0]))[0]
+
+    if statsFile:
+        writeStats(statsFile, getBatchStats(fileStats.values(), options, jobs, time.time() - startTime))
+
+    return failed
+
+# File of a class shared by the modules with the same structure, used on dedup mode
+baseFileRe = re.compile(r'^_Device_[0-9a-f]+\.py$')
+
+# Import of a class shared by the modules with the same structure, from a
+# generated module
+baseImportRe = re.compile(r'^\s*from \.?(_Device_[0-9a-f]+) import ', re.M)
+
+# Get the files of the classes shared by the modules with the same structure
+# which are imported by the python files of the python directory
+def usedBaseFiles(pythonDir):
+    names = set()
+    for fileName in glob.glob(os.path.join(pythonDir, "*.py")):
+        with open(fileName, "r") as f:
+            names.update("%s.py" % name for name in baseImportRe.findall(f.read()))
+    return names
+
+# Shared enum table definition on the shared enums module
+sharedEnumRe = re.compile(r'^(Enum_[0-9a-f]+) = .*\n', re.M)
+
+# Reference to a shared enum table from a generated module
+sharedEnumRefRe = re.compile(r'\b%s\.(Enum_[0-9a-f]+)\b' % enumsModule)
+
+# Get the names of the shared enum tables used by the python files of the
+# python directory, and of the packages on it written on split mode
+def usedSharedEnums(pythonDir):
+    names = set()
+    for fileName in glob.glob(os.path.join(pythonDir, "*.py")) + glob.glob(os.path.join(pythonDir, "*", "*.py")):
+        with open(fileName, "r") as f:
+            names.update(sharedEnumRefRe.findall(f.read()))
+    return names
+
+# Write the module with the shared enum tables into the python directory. The
+# tables already on it are kept, as other modules could use them, unless a
+# set with the names of the tables to keep is given.
+def writeSharedEnums(pythonDir, enums, keep=None):
+    fileName = os.path.join(pythonDir, enumsModule + ".py")
+
+    tables = {}
+    if os.path.isfile(fileName):
+        with open(fileName, "r") as f:
+            for m in sharedEnumRe.finditer(f.read()):
+                tables[m.group(1)] = m.group(0)
+    tables.update(enums)
+
+    if keep is not None:
+        tables = dict((name, tables[name]) for name in tables if name in keep)
+
+    buf = []
+    printSharedHeader(buf, "PyRogue shared enum tables", enumsModule,
+                      "Enum tables shared by the generated modules, named by their content hash",
+                      licenseHeader.replace("import pyrogue as pr\n\n", ""))
+    for name in sorted(tables):
+        buf.append(tables[name])
+
+    writeFileIfChanged(fileName, "".join(buf))
+
+# Get the statistics of a batch conversion: the ones of each file, and
+# their totals
+def getBatchStats(files, options, jobs, wallTime):
+    phases = collections.OrderedDict()
+    counts = collections.OrderedDict()
+    status = collections.OrderedDict([("converted",0), ("skipped",0), ("failed",0)])
+    for f in files:
+        status[f["status"]] += 1
+        for phase, p in f.get("phases", {}).items():
+            phases[phase] = phases.get(phase, 0) + p["time"]
+        for name, count in f.get("counts", {}).items():
+            counts[name] = counts.get(name, 0) + count
+
+    # The workers are child processes, their peak memory is reported apart.
+    # Their peak is reset on each phase, so the one they recorded is used too
+    workerRss = maxRss(resource.RUSAGE_CHILDREN) if resource else None
+    if jobs > 1:
+        peaks = [p["processMaxRssKB"] for f in files for p in f.get("phases", {}).values() if p["processMaxRssKB"] is not None]
+        if workerRss is not None:
+            peaks.append(workerRss)
+        workerRss = max(peaks) if peaks else None
+
+    totals = collections.OrderedDict([
+        ("wallTime",       round(wallTime, 6)),
+        ("maxRssKB",       maxRss()),
+        ("workerMaxRssKB", workerRss),
+        ("phaseTime",      collections.OrderedDict((k, round(v, 6)) for k, v in phases.items())),
+        ("counts",         counts),
+    ])
+    totals.update(status)
+
+    return collections.OrderedDict([
+        ("generator", generatorVersion()),
+        ("created",   datetime.datetime.now().isoformat()),
+        ("options",   options),
+        ("jobs",      jobs),
+        ("totals",    totals),
+        ("files",     list(files)),
+    ])
+
+# Watch a set of directories for changes on their YAML files. It uses inotify
+# when it is available (Linux), and falls back to polling the files otherwise.
+class FileWatcher:
+    # inotify events we are interested in: files written, moved in or out,
+    # created or deleted. Editors often save by renaming a temporary file.
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    inotifyMask    = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    # inotify event header: wd, mask, cookie, len
+    eventHeader     = struct.Struct("iIII")
+
+    def __init__(self, pollInterval=0.5):
+        self.pollInterval = pollInterval
+        self.directories  = {}
+        self.fd           = None
+        self.files        = {}
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init()
+            if fd >= 0:
+                self.libc = libc
+                self.fd   = fd
+        except (OSError, AttributeError):
+            pass
+
+    # Method to get the name of the method used to watch the files
+    def getMethod(self):
+        return "inotify" if self.fd is not None else "polling"
+
+    # Method to add a directory to the watched ones
+    def watch(self, directory):
+        directory = os.path.abspath(directory)
+        if directory in self.directories.values():
+            return
+
+        if self.fd is not None:
+            wd = self.libc.inotify_add_watch(self.fd, directory, self.inotifyMask)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "Can not watch directory \"%s\"" % directory)
+        else:
+            wd = len(self.directories)
+            self.files.update(self.scan(directory))
+
+        self.directories[wd] = directory
+
+    # Method to get the state of the YAML files on a directory, used on polling mode
+    def scan(self, directory):
+        state = {}
+        for yamlFile in glob.glob(os.path.join(directory, "*.yaml")):
+            try:
+                st = os.stat(yamlFile)
+            except OSError:
+                continue
+            state[yamlFile] = (st.st_mtime, st.st_size)
+        return state
+
+    # Method to get the YAML files changed on the watched directories, blocking
+    # until there is at least one change or the timeout (in seconds) expires.
+    # Once there is a change, it keeps collecting them until there is none
+    # for 'debounce' seconds, so a burst of saves is reported only once.
+    def wait(self, timeout=None, debounce=0.2):
+        changed = self.poll(timeout)
+        if not changed:
+            return changed
+
+        while True:
+            more = self.poll(debounce)
+            if not more:
+                return changed
+            changed |= more
+
+    # Method to get the YAML files changed, waiting up to 'timeout' seconds
+    def poll(self, timeout):
+        if self.fd is not None:
+            ready = select.select([self.fd], [], [], timeout)[0]
+            if not ready:
+                return set()
+            return self.readEvents()
+
+        # Polling mode
+        start = time.time()
+        while True:
+            state = {}
+            for directory in self.directories.values():
+                state.update(self.scan(directory))
+
+            changed = set(f for f in set(state) | set(self.files) if state.get(f) != self.files.get(f))
+            self.files = state
+            if changed:
+                return changed
+
+            if timeout is not None and time.time() - start >= timeout:
+                return set()
+
+            if timeout is None:
+                time.sleep(self.pollInterval)
+            else:
+                time.sleep(min(self.pollInterval, timeout))
+
+    # Method to read the pending inotify events, returning the YAML files changed
+    def readEvents(self):
+        changed = set()
+        data = os.read(self.fd, 65536)
+        i = 0
+        while i + self.eventHeader.size <= len(data):
+            wd, mask, cookie, length = self.eventHeader.unpack_from(data, i)
+            i += self.eventHeader.size
+            name = data[i:i + length].rstrip("\0")
+            i += length
+            if name.endswith(".yaml") and wd in self.directories:
+                changed.add(os.path.join(self.directories[wd], name))
+        return changed
+
+# Watch mode: convert the modules, and then keep watching their YAML files and
+# the files they include, converting again the modules affected by each change.
+# The process stays alive, so the interpreter, PyYAML and the files already
+# read are warm, and only the modules whose sources changed are converted.
+def watchModules(findFiles, pythonDir, options, jobs, incremental, cacheDir, statsFile=""):
+    watcher = FileWatcher()
+
+    # Hash of the YAML source of each module, when it was last converted
+    converted = {}
+
+    yamlFiles = findFiles()
+    pending   = yamlFiles
+    while True:
+        # Convert the modules whose source changed. Editors can write a
+        # file without changing it, so the source hash is checked.
+        toConvert = []
+        for yamlFile in pending:
+            try:
+                h = sourceHash(yamlFile)
+            except (IOError, OSError) as e:
+                print "Module %s failed: %s" % (yamlFile, e)
+                continue
+            if converted.get(yamlFile) != h:
+                converted[yamlFile] = h
+                toConvert.append(yamlFile)
+
+        if toConvert:
+            convertModules(toConvert, pythonDir, options, today(), jobs, incremental, cacheDir, statsFile)
+            print ""
+
+        # Watch the directories of the modules and of the files they include
+        for yamlFile in yamlFiles:
+            watcher.watch(os.path.dirname(os.path.abspath(yamlFile)))
+            try:
+                for dep in yamlDependencies(yamlFile):
+                    watcher.watch(os.path.dirname(dep))
+            except (IOError, OSError):
+                pass
+
+        if toConvert or not converted:
+            print "Watching %d modules for changes (%s), press Ctrl-C to stop..." % (len(yamlFiles), watcher.getMethod())
+
+        # Wait for changes, and get the modules affected by them: the ones
+        # which are or include (directly or not) a changed file
+        changed = set()
+        while not changed:
+            changed = set(os.path.abspath(f) for f in watcher.wait())
+
+        yamlFiles = findFiles()
+        pending   = []
+        for yamlFile in yamlFiles:
+            try:
+                deps = yamlDependencies(yamlFile)
+            except (IOError, OSError):
+                deps = [os.path.abspath(yamlFile)]
+            if changed.intersection(deps):
+                pending.append(yamlFile)
+
+        # Forget the modules which don't exist anymore
+        for yamlFile in list(converted):
+            if yamlFile not in yamlFiles:
+                del converted[yamlFile]
+
+# Run the watch mode until it is interrupted
+def runWatch(findFiles, pythonDir, options, jobs, incremental, cacheDir, statsFile=""):
+    try:
+        watchModules(findFiles, pythonDir, options, jobs, incremental, cacheDir, statsFile)
+    except KeyboardInterrupt:
+        print ""
+        print "Stopped"
 
-    # Method to get if this child is a command
-    def isCommand(self):
-        return self.isCommand
+# Get today's date
+def today():
+    return "%d-%02d-%02d" % (datetime.date.today().year, datetime.date.today().month, datetime.date.today().day)
 
 # Main
 def main(argv):
@@ -468,9 +3245,26 @@ def main(argv):
     moduleName  = ""
     title       = ""
     description = ""
+    batch       = ""
+    jobs        = multiprocessing.cpu_count()
+    incremental = False
+    cacheDir    = ""
+    compact     = False
+    split       = 0
+    lazy        = False
+    coalesce    = False
+    batchWrites = False
+    watch       = False
+    statsFile   = ""
+    stream      = False
+    check       = True
+    enums       = False
+    dedup       = False
+    index       = False
+    bulkArrays  = 0
 
     try:
-        opts, args = getopt.getopt(argv, "hM:Y:P:D:T:",["module=", "yamlDir=", "pythonDir=", "description=", "title="])
+        opts, args = getopt.getopt(argv, "hM:Y:P:D:T:B:j:IC:cS:zOWws:XNEdAL:",["module=", "yamlDir=", "pythonDir=", "description=", "title=", "batch=", "jobs=", "incremental", "cacheDir=", "compact", "split=", "lazy", "coalesce", "batchWrites", "watch", "stats=", "stream", "noCheck", "sharedEnums", "dedup", "addressIndex", "bulkArrays="])
     except getopt.GetoptError:
         print "Invalid option!"
         usage(sys.argv[0])
@@ -490,6 +3284,119 @@ def main(argv):
             title = arg
         elif opt in ("-P", "--pythonDir"):
             pythonDir = arg
+        elif opt in ("-B", "--batch"):
+            batch = arg
+        elif opt in ("-j", "--jobs"):
+            try:
+                jobs = int(arg)
+            except ValueError:
+                jobs = 0
+            if jobs < 1:
+                print "Invalid number of jobs \"%s\"!" % arg
+                print ""
+                sys.exit(2)
+        elif opt in ("-I", "--incremental"):
+            incremental = True
+        elif opt in ("-C", "--cacheDir"):
+            cacheDir = arg
+        elif opt in ("-c", "--compact"):
+            compact = True
+        elif opt in ("-S", "--split"):
+            try:
+                split = int(arg)
+            except ValueError:
+                split = 0
+            if split < 1:
+                print "Invalid group size \"%s\"!" % arg
+                print ""
+                sys.exit(2)
+        elif opt in ("-z", "--lazy"):
+            lazy = True
+        elif opt in ("-O", "--coalesce"):
+            coalesce = True
+        elif opt in ("-W", "--batchWrites"):
+            batchWrites = True
+        elif opt in ("-w", "--watch"):
+            watch = True
+        elif opt in ("-s", "--stats"):
+            statsFile = arg
+        elif opt in ("-X", "--stream"):
+            stream = True
+        elif opt in ("-N", "--noCheck"):
+            check = False
+        elif opt in ("-E", "--sharedEnums"):
+            enums = True
+        elif opt in ("-d", "--dedup"):
+            dedup = True
+        elif opt in ("-A", "--addressIndex"):
+            index = True
+        elif opt in ("-L", "--bulkArrays"):
+            try:
+                bulkArrays = int(arg)
+            except ValueError:
+                bulkArrays = 0
+            if bulkArrays < 1:
+                print "Invalid number of elements \"%s\"!" % arg
+                print ""
+                sys.exit(2)
+
+    # These are the options which affect the generated code
+    options = {"title":title, "description":description, "compact":compact, "split":split, "lazy":lazy, "coalesce":coalesce, "batchWrites":batchWrites, "check":check, "sharedEnums":enums, "dedup":dedup, "addressIndex":index, "bulkArrays":bulkArrays}
+
+    # Lazy mode only applies to the packages written on split mode
+    if lazy and not split:
+        print "Option \"lazy\" needs split mode!"
+        print ""
+        sys.exit(2)
+
+    # The classes shared on dedup mode are not supported on split mode
+    if dedup and split:
+        print "Option \"dedup\" is not supported on split mode!"
+        print ""
+        sys.exit(2)
+
+    # Streaming mode doesn't change the generated code. The address map is not
+    # checked, as the bit ranges kept for the check grow with the file size
+    if stream:
+        options["stream"] = True
+        options["check"]  = False
+        for option in YamlStream.unsupportedOptions:
+            if options[option]:
+                print "Option \"%s\" is not supported on streaming mode!" % option
+                print ""
+                sys.exit(2)
+
+    # Get today's date
+    date = today()
+
+    # Batch mode: convert all the modules found
+    if batch:
+        # Verify if the output directory exist
+        if not os.path.exists(pythonDir):
+            print "Directory \"%s\" doesn't exist!" % pythonDir
+            print ""
+            sys.exit(2)
+
+        yamlFiles = findModules(batch)
+        if not yamlFiles:
+            print "No YAML files found on \"%s\"!" % batch
+            print ""
+            sys.exit(2)
+
+        duplicates = duplicateModules(yamlFiles)
+        if duplicates:
+            for name, files in duplicates:
+                print "Module %s is defined by more than one file: %s" % (name, ", ".join(files))
+            print ""
+            sys.exit(2)
+
+        if watch:
+            runWatch(lambda: findModules(batch), pythonDir, options, jobs, incremental, cacheDir, statsFile)
+            return
+
+        if convertModules(yamlFiles, pythonDir, options, date, jobs, incremental, cacheDir, statsFile):
+            sys.exit(1)
+        return
 
     # The module name is mandatory
     if not moduleName:
@@ -512,31 +3419,19 @@ def main(argv):
     # The YAML file full path
     yamlFile = yamlDir + '/' + moduleName + ".yaml"
 
-    # The python file full path
-    pythonFile = pythonDir + '/' + moduleName + ".py"
-
     # Verify is YAML file exist
     if not os.path.isfile(yamlFile):
         print "Yaml file \"%s\" doesn't exist!" % yamlFile
         print ""
         sys.exit(2)
 
-    # Get today's date
-    date = "%d-%02d-%02d" % (datetime.date.today().year, datetime.date.today().month, datetime.date.today().day)
-
-    # Process the YAML file
-    yD = YamlDoc(yamlFile, title, description, date)
-
-    # open the output python file
-    pFile = open(pythonFile, "w")
-
-    # print the equivalent Python class
-    yD.getPyClass(pFile)
-
-    # Close the output python file
-    pFile.close()
+    if watch:
+        runWatch(lambda: [yamlFile] if os.path.isfile(yamlFile) else [], pythonDir, options, 1, incremental, cacheDir, statsFile)
+        return
 
-    print "Module %s converted from %s to %s" % (moduleName, yamlFile, pythonFile)
+    # Convert the YAML file
+    if convertModules([yamlFile], pythonDir, options, date, 1, incremental, cacheDir, statsFile):
+        sys.exit(1)
 
 # Call main 
 if __name__ == "__main__":
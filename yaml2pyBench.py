@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+import sys
+import os
+import getopt
+import time
+import json
+import shutil
+import tempfile
+import imp
+import collections
+import itertools
+import yaml2py
+import memSim
+
+# pyrogue is only needed by the runtime benchmark
+try:
+    import pyrogue as pr
+except ImportError:
+    pr = None
+
+# Print usage message
+def usage(name):
+    print "Usage: python %s [-h|--help] [-r|--repeat repeat] [-s|--scenario name] [-o|--output results_file] [-b|--baseline baseline_file] [-t|--tolerance tolerance] [-R|--runtime] [-c|--check]" % name
+    print "    -h|--help                           : show this message"
+    print "    -r|--repeat repeat                  : number of times each phase is run. The best time is used. Default: 3"
+    print "    -s|--scenario name                  : run only this scenario. Can be used several times."
+    print "                                          If empty, all the scenarios are run."
+    print "    -o|--output results_file            : save the results on this file, to be used as baseline later"
+    print "    -b|--baseline baseline_file         : compare the results with the ones saved on this file, and fail"
+    print "                                          if any phase is slower than the tolerance allows"
+    print "    -t|--tolerance tolerance            : allowed slow down against the baseline, as a fraction. Default: 0.2"
+    print "    -R|--runtime                        : instead of the conversion, measure the generated devices running on a"
+    print "                                          simulated memory (memSim.py): transactions, bytes moved and time of a"
+    print "                                          read of all the variables, a write of all of them, and each command."
+    print "                                          Needs pyrogue."
+    print "    -c|--check                          : instead of the benchmark, check the in-process API on every combination"
+    print "                                          of the code generation options: the models are cached and copied, and"
+    print "                                          the copies give the same code and report."
+    print ""
+    print "Scenarios:"
+    for s in scenarios:
+        print "    %-16s: %s" % (s["name"], s["description"])
+    print ""
+
+# Benchmark scenarios. Each one describes the synthetic register map generated:
+#   modules  : number of modules (YAML files)
+#   fields   : number of IntFields on each module
+#   enumEvery: one of each 'enumEvery' IntFields is an enum (0 for none)
+#   enumSize : number of values of each enum
+#   arrayEvery: one of each 'arrayEvery' IntFields is an array (0 for none)
+#   nelms    : number of elements of each array
+#   commands : number of SequenceCommands on each module
+#   seqLength: number of entries on each command sequence
+#   options  : code generation options
+scenarios = [
+    {"name":"small", "description":"many small modules",
+     "modules":100, "fields":20, "enumEvery":5, "enumSize":2, "arrayEvery":0, "nelms":0, "commands":2, "seqLength":5, "options":{}},
+    {"name":"large", "description":"one module with 10000 IntFields",
+     "modules":1, "fields":10000, "enumEvery":0, "enumSize":0, "arrayEvery":0, "nelms":0, "commands":0, "seqLength":0, "options":{}},
+    {"name":"enums", "description":"modules with big enums",
+     "modules":4, "fields":500, "enumEvery":1, "enumSize":32, "arrayEvery":0, "nelms":0, "commands":0, "seqLength":0, "options":{}},
+    {"name":"arrays", "description":"modules with big arrays",
+     "modules":4, "fields":200, "enumEvery":0, "enumSize":0, "arrayEvery":2, "nelms":4096, "commands":0, "seqLength":0, "options":{}},
+    {"name":"sequences", "description":"modules with long command sequences",
+     "modules":4, "fields":200, "enumEvery":0, "enumSize":0, "arrayEvery":0, "nelms":0, "commands":50, "seqLength":100, "options":{}},
+    {"name":"compact", "description":"one module with 10000 IntFields, compact mode",
+     "modules":1, "fields":10000, "enumEvery":10, "enumSize":2, "arrayEvery":0, "nelms":0, "commands":0, "seqLength":0, "options":{"compact":True}},
+    {"name":"bulkArrays", "description":"modules with big arrays, bulk arrays mode",
+     "modules":4, "fields":200, "enumEvery":0, "enumSize":0, "arrayEvery":2, "nelms":4096, "commands":0, "seqLength":0, "options":{"bulkArrays":1024}},
+    {"name":"coalesce", "description":"one module with 2000 IntFields, coalesce mode",
+     "modules":1, "fields":2000, "enumEvery":0, "enumSize":0, "arrayEvery":0, "nelms":0, "commands":0, "seqLength":0, "options":{"coalesce":True}},
+    {"name":"batchWrites", "description":"modules with long command sequences, batch writes mode",
+     "modules":4, "fields":200, "enumEvery":0, "enumSize":0, "arrayEvery":0, "nelms":0, "commands":50, "seqLength":100, "options":{"batchWrites":True}},
+]
+
+# Generate the YAML definition of a synthetic module
+def genModule(name, s):
+    out = []
+    out.append("%s: &%s\n" % (name, name))
+    out.append("  name: %s\n" % name)
+    out.append("  description: Synthetic module %s\n" % name)
+    out.append("  class: MMIODev\n")
+    out.append("  size: 0x%X\n" % (0x100000))
+    out.append("  children:\n")
+
+    # Fields are packed two per word, arrays go after all the fields
+    arrayOffset = ((s["fields"] * 2 + 0xFFF) // 0x1000) * 0x1000
+    for i in range(s["fields"]):
+        out.append("    Field%d:\n" % i)
+        out.append("      at:\n")
+        if s["arrayEvery"] and i % s["arrayEvery"] == 0:
+            out.append("        offset: 0x%X\n" % arrayOffset)
+            out.append("        nelms: %d\n" % s["nelms"])
+            out.append("        stride: 4\n")
+            arrayOffset += s["nelms"] * 4
+            size, lsBit = 32, 0
+        else:
+            out.append("        offset: 0x%X\n" % ((i // 2) * 4))
+            size, lsBit = 16, (i % 2) * 16
+        out.append("      class: IntField\n")
+        out.append("      sizeBits: %d\n" % size)
+        out.append("      lsBit: %d\n" % lsBit)
+        out.append("      mode: RW\n")
+        out.append("      description: Synthetic field %d\n" % i)
+        if s["enumEvery"] and i % s["enumEvery"] == 0:
+            out.append("      enums:\n")
+            for v in range(s["enumSize"]):
+                out.append("        - name: Value%d\n" % v)
+                out.append("          class: Enum\n")
+                out.append("          value: %d\n" % v)
+
+    for c in range(s["commands"]):
+        out.append("    Command%d:\n" % c)
+        out.append("      class: SequenceCommand\n")
+        out.append("      at:\n")
+        out.append("        offset: 0x0\n")
+        out.append("      description: Synthetic command %d\n" % c)
+        out.append("      sequence:\n")
+        for e in range(s["seqLength"]):
+            out.append("        - entry: Field%d\n" % ((c + e) % s["fields"]))
+            out.append("          value: 0x%X\n" % e)
+
+    return "".join(out)
+
+# Code generation options checked by the API check, with their values. The
+# combinations not supported (lazy mode without split mode, and dedup mode
+# with split mode) are left out
+checkOptions = collections.OrderedDict([
+    ("compact",     (False, True)),
+    ("split",       (0, 8)),
+    ("lazy",        (False, True)),
+    ("coalesce",    (False, True)),
+    ("batchWrites", (False, True)),
+    ("sharedEnums", (False, True)),
+    ("dedup",       (False, True)),
+    ("bulkArrays",  (0, 16)),
+    ("check",       (False, True)),
+])
+
+# Check the in-process API on every combination of the code generation
+# options, with a synthetic module with enums, arrays and commands, and a
+# module without children. Each model is built, cached and got again from
+# the cache, which gives a copy: both must give the same code and report.
+# Return the list of combinations failing, with their errors
+def runCheck():
+    s = {"fields":20, "enumEvery":5, "enumSize":4, "arrayEvery":10, "nelms":32, "commands":2, "seqLength":5}
+    source = genModule("Check", s) + "Empty:\n  class: MMIODev\n  size: 0x100\n  description: Module without children\n"
+
+    failures = []
+    for values in itertools.product(*checkOptions.values()):
+        options = dict(zip(checkOptions.keys(), values))
+        if (options["lazy"] and not options["split"]) or (options["dedup"] and options["split"]):
+            continue
+
+        try:
+            results = []
+            for i in range(2):
+                yD   = yaml2py.yamlToModel(source, date="2017-01-01", options=options)
+                code = yD.renderPackage() if options["split"] else yD.render()
+                results.append((code, yD.getReport(), yD.getBases(), yD.getEnums()))
+            if results[0] != results[1]:
+                failures.append("%r: the cached copy gives a different result" % options)
+        except Exception as e:
+            failures.append("%r: %s: %s" % (options, type(e).__name__, e))
+
+    return failures
+
+# Get the best time of several runs of a function, and the result of the last run
+def bestTime(repeat, function):
+    best = None
+    for i in range(repeat):
+        start  = time.time()
+        result = function()
+        t      = time.time() - start
+        if best is None or t < best:
+            best = t
+    return best, result
+
+# Run a scenario. Return the time spent on each phase: YAML parsing, model
+# building (YamlDoc, YamlModule and YamlChild) and code emission
+def runScenario(s, repeat):
+    tmpDir = tempfile.mkdtemp(prefix="yaml2pyBench")
+    try:
+        yamlFiles = []
+        size = 0
+        for m in range(s["modules"]):
+            name = "Synth%d" % m
+            yamlFile = os.path.join(tmpDir, name + ".yaml")
+            with open(yamlFile, "w") as f:
+                f.write(genModule(name, s))
+            size += os.path.getsize(yamlFile)
+            yamlFiles.append(yamlFile)
+
+        options = {"title":"", "description":""}
+        options.update(s["options"])
+
+        parse, docs = bestTime(repeat, lambda: [yaml2py.loadYaml(f) for f in yamlFiles])
+        build, yDs  = bestTime(repeat, lambda: [yaml2py.YamlDoc(f, "", "", "2017-01-01", options=options, doc=d) for f, d in zip(yamlFiles, docs)])
+        emit, codes = bestTime(repeat, lambda: [yD.render() for yD in yDs])
+    finally:
+        shutil.rmtree(tmpDir)
+
+    return {
+        "yamlBytes"  : size,
+        "outputBytes": sum(len(c) for c in codes),
+        "parse"      : parse,
+        "build"      : build,
+        "emit"       : emit,
+    }
+
+# Run an operation of a device on the simulated memory. Return the best
+# time and the transaction counts of the last run
+def measure(memory, repeat, function):
+    def run():
+        memory.resetCounts()
+        function()
+        return memory.getCounts()
+    return bestTime(repeat, run)
+
+# Add the time and the transaction counts of an operation to the results
+def addOperation(result, operation, t, counts):
+    result[operation]                  += t
+    result[operation + "Transactions"] += counts["transactions"]
+    result[operation + "Bytes"]        += counts["bytesRead"] + counts["bytesWritten"]
+
+# Run the generated devices of a scenario on a simulated memory. Return the
+# time, transactions and bytes moved reading all the variables, writing all
+# of them and running all the commands, and of each command. On coalesce
+# mode, the raw read of the whole device following its bulk read plan is
+# measured too, apart, as it doesn't update the variables
+def runRuntime(s, repeat):
+    tmpDir = tempfile.mkdtemp(prefix="yaml2pyBench")
+    result = collections.OrderedDict()
+    for operation in ("readAll", "rawRead", "writeAll", "commands"):
+        result[operation]                  = 0.0
+        result[operation + "Transactions"] = 0
+        result[operation + "Bytes"]        = 0
+    commands = collections.OrderedDict()
+
+    options = {"title":"", "description":""}
+    options.update(s["options"])
+
+    try:
+        for m in range(s["modules"]):
+            name = "Synth%d" % m
+            pythonFile = os.path.join(tmpDir, name + ".py")
+            with open(pythonFile, "w") as f:
+                f.write(yaml2py.yamlToPython(genModule(name, s), date="2017-01-01", options=options))
+            module = imp.load_source("yaml2pyBench_%s_%s" % (s["name"], name), pythonFile)
+
+            memory = memSim.SimMemory()
+            root   = pr.Root(name="bench", description="")
+            dev    = getattr(module, name)(memBase=memSim.MemSim(memory))
+
+            # On lazy mode, build all the children before the device is added
+            # to the root, as it doesn't accept new nodes once it is started
+            if hasattr(dev, "loadAll"):
+                dev.loadAll()
+
+            root.add(dev)
+            root.start()
+
+            # On bulk arrays mode, the large arrays are local variables of the
+            # device, read and written as a block by their get and set functions
+            def readAll():
+                dev.readBlocks(recurse=True)
+                dev.checkBlocks(recurse=True)
+
+            def writeAll():
+                dev.writeBlocks(force=True, recurse=True)
+                dev.checkBlocks(recurse=True)
+
+            try:
+                addOperation(result, "readAll", *measure(memory, repeat, readAll))
+                if hasattr(dev, "readBulk"):
+                    addOperation(result, "rawRead", *measure(memory, repeat, dev.readBulk))
+                addOperation(result, "writeAll", *measure(memory, repeat, writeAll))
+                for cmdName, cmd in dev.commands.items():
+                    t, counts = measure(memory, repeat, cmd)
+                    addOperation(result, "commands", t, counts)
+                    commands["%s.%s" % (name, cmdName)] = {"time":t, "transactions":counts["transactions"],
+                                                           "bytes":counts["bytesRead"] + counts["bytesWritten"]}
+            finally:
+                root.stop()
+    finally:
+        shutil.rmtree(tmpDir)
+
+    result["commandCount"]  = len(commands)
+    result["commandDetail"] = commands
+    result["rogueVersion"]  = memSim.rogueVersion()
+    return result
+
+# Methods of pyrogue devices used by the generated devices and the runtime benchmark
+runtimeApi = ("addVariable", "addVariables", "addCommand", "readBlocks", "writeBlocks", "checkBlocks")
+
+# Time phases and transaction counts compared with the baseline
+timePhases        = ("parse", "build", "emit", "readAll", "rawRead", "writeAll", "commands")
+transactionCounts = ("readAllTransactions", "rawReadTransactions", "writeAllTransactions", "commandsTransactions")
+
+# Compare the results with a baseline. Return the list of regressions found
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name in results:
+        if name not in baseline:
+            continue
+        for phase in timePhases:
+            if phase not in results[name] or phase not in baseline[name]:
+                continue
+            new = results[name][phase]
+            old = baseline[name][phase]
+            # Ignore differences under 1 ms, they are just noise
+            if new > old * (1 + tolerance) and new - old > 0.001:
+                regressions.append("%s %s: %.4f s, baseline %.4f s (%+.0f%%)" % (name, phase, new, old, (new / old - 1) * 100))
+        # The number of transactions doesn't depend on the machine, any increase is a regression
+        for count in transactionCounts:
+            if count not in results[name] or count not in baseline[name]:
+                continue
+            new = results[name][count]
+            old = baseline[name][count]
+            if new > old:
+                regressions.append("%s %s: %d, baseline %d" % (name, count, new, old))
+    return regressions
+
+# Main
+def main(argv):
+    # Process input arguments
+    repeat    = 3
+    names     = []
+    output    = ""
+    baseline  = ""
+    tolerance = 0.2
+    runtime   = False
+    check     = False
+
+    try:
+        opts, args = getopt.getopt(argv, "hr:s:o:b:t:Rc",["repeat=", "scenario=", "output=", "baseline=", "tolerance=", "runtime", "check"])
+    except getopt.GetoptError:
+        print "Invalid option!"
+        usage(sys.argv[0])
+        sys.exit(2)
+
+    try:
+        for opt, arg in opts:
+            if opt in ("-h", "--help"):
+                usage(sys.argv[0])
+                sys.exit()
+            elif opt in ("-r", "--repeat"):
+                repeat = int(arg)
+            elif opt in ("-s", "--scenario"):
+                names.append(arg)
+            elif opt in ("-o", "--output"):
+                output = arg
+            elif opt in ("-b", "--baseline"):
+                baseline = arg
+            elif opt in ("-t", "--tolerance"):
+                tolerance = float(arg)
+            elif opt in ("-R", "--runtime"):
+                runtime = True
+            elif opt in ("-c", "--check"):
+                check = True
+    except ValueError:
+        print "Invalid value \"%s\" for option %s!" % (arg, opt)
+        print ""
+        sys.exit(2)
+
+    for name in names:
+        if name not in [s["name"] for s in scenarios]:
+            print "Unknown scenario \"%s\"!" % name
+            usage(sys.argv[0])
+            sys.exit(2)
+
+    # Check the in-process API instead of running the benchmark
+    if check:
+        failures = runCheck()
+        for f in failures:
+            print f
+        if failures:
+            print "%d option combinations failed the API check" % len(failures)
+            sys.exit(1)
+        print "All option combinations passed the API check"
+        return
+
+    if runtime and (pr is None or memSim.MemSim is None):
+        print "The runtime benchmark needs pyrogue!"
+        print ""
+        sys.exit(2)
+
+    # The generated devices use the pyrogue API of the generator: variables
+    # and commands added with addVariable/addCommand, and block transactions
+    if runtime:
+        missing = [method for method in runtimeApi if not hasattr(pr.Device, method)]
+        if not hasattr(pr, "LocalVariable"):
+            missing.append("LocalVariable")
+        if missing:
+            print "The runtime benchmark needs pyrogue with %s (rogue %s)!" % (", ".join(missing), memSim.rogueVersion())
+            print ""
+            sys.exit(2)
+        print "Rogue %s" % memSim.rogueVersion()
+        print ""
+
+    # Run the scenarios
+    results = {}
+    if runtime:
+        print "%-12s %12s %8s %9s %12s %8s %12s %8s %9s %6s %12s %8s" % ("Scenario", "Read (s)", "Read tr", "Read kB", "Raw rd (s)", "Raw tr",
+                                                                       "Write (s)", "Write tr", "Write kB", "Cmds", "Cmd avg (ms)", "Cmd tr")
+    else:
+        print "%-12s %10s %10s %10s %10s %12s" % ("Scenario", "YAML (kB)", "Parse (s)", "Build (s)", "Emit (s)", "Output (kB)")
+    for s in scenarios:
+        if names and s["name"] not in names:
+            continue
+        if runtime:
+            r = runRuntime(s, repeat)
+            results[s["name"]] = r
+            print "%-12s %12.4f %8d %9d %12.4f %8d %12.4f %8d %9d %6d %12.3f %8d" % (s["name"], r["readAll"], r["readAllTransactions"], r["readAllBytes"] // 1024,
+                                                                                 r["rawRead"], r["rawReadTransactions"],
+                                                                                 r["writeAll"], r["writeAllTransactions"], r["writeAllBytes"] // 1024,
+                                                                                 r["commandCount"], r["commands"] * 1000 / max(r["commandCount"], 1), r["commandsTransactions"])
+        else:
+            r = runScenario(s, repeat)
+            results[s["name"]] = r
+            print "%-12s %10d %10.4f %10.4f %10.4f %12d" % (s["name"], r["yamlBytes"] // 1024, r["parse"], r["build"], r["emit"], r["outputBytes"] // 1024)
+
+    # Save the results
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+            f.write("\n")
+        print ""
+        print "Results saved on %s" % output
+
+    # Compare with the baseline
+    if baseline:
+        with open(baseline, "r") as f:
+            regressions = compare(results, json.load(f), tolerance)
+
+        print ""
+        if regressions:
+            print "Performance regressions found against %s:" % baseline
+            for r in regressions:
+                print "    %s" % r
+            sys.exit(1)
+        print "No performance regressions found against %s" % baseline
+
+# Call main
+if __name__ == "__main__":
+    main(sys.argv[1:])